@@ -0,0 +1,133 @@
+# (c) 2016 Anaconda, Inc. / https://anaconda.com
+# All Rights Reserved
+#
+# constructor is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+"""
+persistent indexes kept in the constructor cache directory
+"""
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import json
+import os
+from os.path import basename, isdir, join
+
+from .utils import hash_files, write_file_atomic
+
+DIGEST_INDEX_FN = '.constructor-digests.json'
+SOLVE_CACHE_DIR = '.constructor-solves'
+REPODATA_CACHE_DIR = '.constructor-repodata'
+MANIFEST_FN = 'constructor-manifest.json'
+
+
+def stat_key(path):
+    """
+    Return (size, mtime in ns, inode) of `path`, which changes whenever the
+    content of the file is modified or the file is replaced.
+    """
+    st = os.stat(path)
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:  # Python 2
+        mtime_ns = int(st.st_mtime * 1e9)
+    return [st.st_size, mtime_ns, st.st_ino]
+
+
+class DigestIndex(object):
+    """
+    Digests of the files in a directory, stored in `DIGEST_INDEX_FN` inside
+    that directory.  The digests of a file are only recomputed when its stat
+    key has changed, or when `verify` is true.
+    """
+    def __init__(self, directory, verify=False):
+        self.path = join(directory, DIGEST_INDEX_FN)
+        self.verify = verify
+        self._modified = False
+        try:
+            with open(self.path) as fi:
+                self._entries = json.load(fi)
+        except (IOError, ValueError):
+            self._entries = {}
+
+    def digests(self, path, algorithms=('md5', 'sha256')):
+        """
+        Return the hex digests and the size of the file `path` as a dict, see
+        `utils.hash_files()`.  The file is hashed again when the entry lacks
+        any of the digests `algorithms`.
+        """
+        key = stat_key(path)
+        entry = self._entries.get(basename(path))
+        if (self.verify or entry is None or entry['stat'] != key or
+                any(name not in entry for name in algorithms)):
+            entry = hash_files([path])
+            entry['stat'] = key
+            self._entries[basename(path)] = entry
+            self._modified = True
+        return dict((k, v) for k, v in entry.items() if k != 'stat')
+
+    def add(self, path, digests):
+        """
+        Record the already known `digests` of the file `path`, e.g. after they
+        were verified while the file was downloaded.
+        """
+        entry = dict(digests)
+        entry['stat'] = stat_key(path)
+        self._entries[basename(path)] = entry
+        self._modified = True
+
+    def save(self):
+        if self._modified:
+            write_file_atomic(self.path, json.dumps(self._entries, sort_keys=True))
+            self._modified = False
+
+
+def solve_cache_key(*args):
+    """
+    Return a hex digest identifying a solve, which is computed from `args`.
+    All arguments need to be JSON serializable.
+    """
+    data = json.dumps(args, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def read_solve_cache(directory, key):
+    """
+    Return the list of package records (as dicts) stored for `key`, or None
+    when the solve is not cached.
+    """
+    try:
+        with open(join(directory, SOLVE_CACHE_DIR, key + '.json')) as fi:
+            return json.load(fi)
+    except (IOError, ValueError):
+        return None
+
+
+def write_solve_cache(directory, key, records):
+    cache_dir = join(directory, SOLVE_CACHE_DIR)
+    if not isdir(cache_dir):
+        os.makedirs(cache_dir)
+    write_file_atomic(join(cache_dir, key + '.json'), json.dumps(records, sort_keys=True))
+
+
+def read_manifest(extracted_package_dir, md5):
+    """
+    Return the (paths, total size) stored for the extracted package, or None
+    when no manifest was stored for the package with checksum `md5`.
+    """
+    try:
+        with open(join(extracted_package_dir, 'info', MANIFEST_FN)) as fi:
+            manifest = json.load(fi)
+    except (IOError, ValueError):
+        return None
+    if manifest.get('md5') != md5:
+        return None
+    return manifest['paths'], manifest['size']
+
+
+def write_manifest(extracted_package_dir, md5, paths, size):
+    data = json.dumps({'md5': md5, 'paths': paths, 'size': size}, separators=(',', ':'))
+    try:
+        write_file_atomic(join(extracted_package_dir, 'info', MANIFEST_FN), data)
+    except (IOError, OSError):
+        # e.g. a read-only package cache, the manifest is just an optimization
+        pass
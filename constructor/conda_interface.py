@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import io
 import json
-from os.path import join
+import os
+import re
+from os.path import getmtime, getsize, isdir, isfile, join
 import sys
-import json
+import time
+
+from .utils import iter_json_items, write_file_atomic
 
 NAV_APPS = ['glueviz', 'jupyterlab', 'notebook', 'orange3', 'qtconsole', 'rstudio', 'spyder', 'vscode']
 
@@ -30,12 +35,19 @@ if conda_interface_type == 'conda':
     )
     from conda.core.prefix_data import PrefixData as _PrefixData
     from conda.core.solve import Solver as _Solver
+    from conda.core.subdir_data import (
+        Response304ContentUnchanged as _Response304ContentUnchanged,
+        SubdirData as _SubdirData, read_mod_and_etag as _read_mod_and_etag,
+    )
     from conda.exports import default_prefix as _default_prefix
-    from conda.models.channel import all_channel_urls as _all_channel_urls
+    from conda.models.channel import Channel as _Channel, all_channel_urls as _all_channel_urls
+    from conda.gateways.disk.create import extract_tarball as _extract_tarball
     from conda.gateways.disk.read import read_paths_json as _read_paths_json
     from conda.models.dist import Dist as _Dist
+    from conda.models.enums import PathType as _PathType
     from conda.exports import MatchSpec as _MatchSpec
     from conda.exports import download as _download
+    from conda.models.records import PackageRecord as _PackageRecord
     try:
         from conda.models.records import PackageCacheRecord as _PackageCacheRecord
     except ImportError:
@@ -46,7 +58,10 @@ if conda_interface_type == 'conda':
     Solver, read_paths_json = _Solver, _read_paths_json
     concatv, get, groupby, all_channel_urls = _concatv, _get, _groupby, _all_channel_urls
     conda_context, env_vars, conda_replace_context_default = _conda_context, _env_vars, _conda_replace_context_default
-    download, PackageCacheRecord = _download, _PackageCacheRecord
+    download, PackageCacheRecord, PackageRecord = _download, _PackageCacheRecord, _PackageRecord
+    extract_tarball = _extract_tarball
+    Channel, SubdirData = _Channel, _SubdirData
+    PathType = _PathType
 
     # used by preconda.py
     Dist, MatchSpec, PrefixData, default_prefix = _Dist, _MatchSpec, _PrefixData, _default_prefix
@@ -56,37 +71,154 @@ if conda_interface_type == 'conda':
 
     from conda.exports import cache_fn_url as _cache_fn_url
 
-    def get_repodata(url):
-        if CONDA_MAJOR_MINOR >= (4, 5):
+    def _fetch_raw_repodata(url, etag=None, mod_stamp=None, repodata_fn='repodata.json'):
+        """
+        Return the raw repodata of `url`, or raise Response304ContentUnchanged
+        when it has not changed compared to `etag` and `mod_stamp`.  Other
+        repodata files than repodata.json require conda >= 4.7.
+        """
+        if CONDA_MAJOR_MINOR >= (4, 7):
             from conda.core.subdir_data import fetch_repodata_remote_request
-            raw_repodata_str = fetch_repodata_remote_request(url, None, None)
+            raw_repodata_str = fetch_repodata_remote_request(url, etag, mod_stamp,
+                                                             repodata_fn=repodata_fn)
+        elif CONDA_MAJOR_MINOR >= (4, 5):
+            from conda.core.subdir_data import fetch_repodata_remote_request
+            raw_repodata_str = fetch_repodata_remote_request(url, etag, mod_stamp)
         elif CONDA_MAJOR_MINOR >= (4, 4):
             from conda.core.repodata import fetch_repodata_remote_request
-            raw_repodata_str = fetch_repodata_remote_request(url, None, None)
+            raw_repodata_str = fetch_repodata_remote_request(url, etag, mod_stamp)
         elif CONDA_MAJOR_MINOR >= (4, 3):
             from conda.core.repodata import fetch_repodata_remote_request
-            repodata_obj = fetch_repodata_remote_request(None, url, None, None)
+            repodata_obj = fetch_repodata_remote_request(None, url, etag, mod_stamp)
             raw_repodata_str = json.dumps(repodata_obj)
         else:
             raise NotImplementedError("unsupported version of conda: %s" % CONDA_INTERFACE_VERSION)
-        full_repodata = json.loads(raw_repodata_str)
-        return full_repodata
+        return raw_repodata_str
+
+    def get_repodata(url, cache_dir, max_age=0, offline=False):
+        """
+        Return the path of the raw repodata of `url`, which is kept in
+        `cache_dir`.  Once it is older than `max_age` seconds, it is only
+        downloaded again when its etag or modification time changed.  In
+        `offline` mode, the cached repodata is always used.
+        """
+        cache_path = join(cache_dir, _cache_fn_url(url))
+        if isfile(cache_path):
+            if not offline and time.time() - getmtime(cache_path) >= max_age:
+                mod_etag = _read_mod_and_etag(cache_path)
+                try:
+                    raw_repodata_str = _fetch_raw_repodata(url, mod_etag.get('_etag'),
+                                                           mod_etag.get('_mod'))
+                except _Response304ContentUnchanged:
+                    # restart the max_age period
+                    os.utime(cache_path, None)
+                else:
+                    write_file_atomic(cache_path, raw_repodata_str)
+        elif offline:
+            sys.exit("Error: no cached repodata for '%s' in offline mode" % url)
+        else:
+            raw_repodata_str = _fetch_raw_repodata(url)
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # e.g. created concurrently by another thread
+                if not isdir(cache_dir):
+                    raise
+            write_file_atomic(cache_path, raw_repodata_str)
+        return cache_path
+
+    def _raw_repodata_stamps(raw_repodata_str):
+        # conda puts the saved response headers at the start of the document
+        head = raw_repodata_str[:1024]
+        etag = re.search(r'"_etag": ?"(.*?[^\\])"', head)
+        mod = re.search(r'"_mod": ?"(.*?[^\\])"', head)
+        return etag and etag.group(1), mod and mod.group(1)
+
+    def repodata_stamps(url, refresh=True):
+        """
+        Return the (repodata filename, etag, last modified) triples of the
+        repodata files which the solver reads for the channel subdir `url`,
+        taken from the files cached by conda, or None for files not cached.
+        With `refresh`, a cached file is revalidated by a conditional request,
+        and the stamps of the new content are returned when it changed.  The
+        repodata itself is never parsed.
+        """
+        # conda >= 4.7 first tries current_repodata.json
+        repodata_fns = getattr(conda_context, 'repodata_fns', None) or ['repodata.json']
+        stamps = []
+        for repodata_fn in repodata_fns:
+            if CONDA_MAJOR_MINOR >= (4, 7):
+                subdir_data = SubdirData(Channel(url), repodata_fn=repodata_fn)
+            else:
+                subdir_data = SubdirData(Channel(url))
+            cache_path = subdir_data.cache_path_json
+            if not isfile(cache_path):
+                stamps.append((repodata_fn, None, None))
+                continue
+            mod_etag = _read_mod_and_etag(cache_path)
+            etag, mod = mod_etag.get('_etag'), mod_etag.get('_mod')
+            if refresh and not conda_context.offline:
+                try:
+                    raw_repodata_str = _fetch_raw_repodata(url, etag, mod, repodata_fn)
+                except _Response304ContentUnchanged:
+                    pass
+                else:
+                    etag, mod = _raw_repodata_stamps(raw_repodata_str)
+            stamps.append((repodata_fn, etag, mod))
+        return stamps
 
-    def write_repodata(cache_dir, url, full_repodata, used_packages):
-        used_repodata = {k: full_repodata[k] for k in set(full_repodata.keys()) - set(('packages',
-                                                                                       'packages.conda',
-                                                                                       'removed',))}
+    def read_repodata(path, used_packages=frozenset(), nav_apps=NAV_APPS):
+        """
+        Return the repodata in `path`, keeping only the entries whose filename
+        is in `used_packages`, and the 'packages' entries whose package name is
+        in `nav_apps`.  Both should be sets, as they are looked up once per
+        entry.  The file is parsed incrementally, so the full repodata is never
+        held in memory.
+        """
+        repodata = {'packages': {}, 'packages.conda': {}}
+        with io.open(path, encoding='utf-8') as fi:
+            for keys, value in iter_json_items(fi, ('packages', 'packages.conda')):
+                if len(keys) == 1:
+                    repodata[keys[0]] = value
+                elif keys[1] in used_packages or (keys[0] == 'packages' and
+                                                  value.get('name') in nav_apps):
+                    repodata[keys[0]][keys[1]] = value
+        return repodata
+
+    def write_repodata(cache_dir, url, repodata, minify=False, state=False):
+        """
+        Write `repodata`, as returned by read_repodata(), into the conda index
+        cache directory `cache_dir`, as minified JSON when `minify` is true.
+        When `state` is true, the .state.json file used by newer versions of
+        conda to validate the cached file is written alongside it.  Returns the
+        path of the written repodata.
+        """
+        used_repodata = {k: v for k, v in repodata.items() if k != 'removed'}
         repodata_filename = _cache_fn_url(used_repodata['_url'].rstrip("/"))
-        used_repodata['packages.conda'] = {}
+        used_repodata.setdefault('packages', {})
+        used_repodata.setdefault('packages.conda', {})
         used_repodata['removed'] = []
         # arbitrary old, expired date, so that conda will want to immediately update it
         # when not being run in offline mode
         used_repodata['_mod'] = "Mon, 07 Jan 2019 15:22:15 GMT"
-        used_repodata['packages'] = {k: v for k, v in full_repodata['packages'].items() if v['name'] in NAV_APPS}
-        for package in used_packages:
-            for key in ('packages', 'packages.conda'):
-                if package in full_repodata.get(key, {}):
-                    used_repodata[key][package] = full_repodata[key][package]
-        with open(join(cache_dir, repodata_filename), 'w') as fh:
-            json.dump(used_repodata, fh, indent=2)
-
+        path = join(cache_dir, repodata_filename)
+        with open(path, 'w') as fh:
+            if minify:
+                json.dump(used_repodata, fh, separators=(',', ':'))
+            else:
+                json.dump(used_repodata, fh, indent=2)
+        if state:
+            # tarballs only keep the modification time in whole seconds
+            mtime = int(time.time())
+            os.utime(path, (mtime, mtime))
+            state_data = {
+                'url': used_repodata['_url'],
+                'etag': '',
+                'mod': used_repodata['_mod'],
+                'cache_control': '',
+                'mtime_ns': mtime * 10 ** 9,
+                'size': getsize(path),
+            }
+            with open(path[:-len('.json')] + '.state.json', 'w') as fh:
+                json.dump(state_data, fh, indent=2)
+        return path
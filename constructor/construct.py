@@ -82,6 +82,21 @@ only supported on Windows.  By default, all menu items will be installed.
     ('ignore_duplicate_files',  False, bool, '''
 By default, constructor will error out when adding packages with duplicate
 files in them. Enable this option to warn instead and continue.
+'''),
+
+    ('fetch_workers',          False, int, '''
+Number of conda packages which are downloaded (and verified) concurrently
+while creating the installer.  The same number of threads is used for reading
+the file lists of the packages, and for downloading the repodata of the
+channels.  The default is 4.  This may also be set using
+the `--fetch-workers` command line option, which takes precedence.
+'''),
+
+    ('extract_workers',        False, int, '''
+Number of processes used to extract the downloaded conda packages into the
+package cache concurrently.  Extraction starts as soon as a package has been
+downloaded.  Defaults to the number of CPUs.  This may also be set using the
+`--extract-workers` command line option, which takes precedence.
 '''),
 
     ('install_in_dependency_order', False, bool, '''
@@ -94,6 +109,25 @@ order (unless the explicit list in `packages` is used).
     ('conda_default_channels', False, list, '''
 You can list conda channels here which will be the default conda channels
 of the created installer (if it includes conda).
+'''),
+
+    ('navigator_apps',         False, list, '''
+Names of the packages which are kept in the index cache of the installer, even
+when they are not installed, such that Anaconda Navigator can offer them to
+the user.  By default, these are the applications known to Navigator, use an
+empty list to only keep the installed packages.
+'''),
+
+    ('minify_index_cache',     False, bool, '''
+Write the index cache of the installer (in `pkgs/cache`) as minified JSON,
+instead of indented JSON, which makes it smaller and faster for conda to load.
+The sizes of both formats, and the time taken to parse them, are shown in
+verbose mode.
+'''),
+
+    ('index_cache_state',      False, bool, '''
+Also write the `.state.json` files, which newer versions of conda use to
+validate the index cache, next to the index cache of the installer.
 '''),
 
     ('installer_filename',     False, str, '''
@@ -104,6 +138,24 @@ will determined by the `name`, `version`, platform and installer type.
     ('installer_type',     False, str, '''
 The type of the installer being created.  Possible values are "sh", "pkg",
 and "exe".  By default, the type is "sh" on Unix, and "exe" on Windows.
+'''),
+
+    ('payload_compression',    False, str, '''
+Compression of the payload of ".sh" installers, which is one of "none" (the
+default), "bz2", "xz" or "zstd".  Multi-threaded compressors (`lbzip2`,
+`pbzip2`, `xz -T` and `zstd -T`) are used when available, and the installer
+also decompresses the payload in parallel when it can.  The corresponding
+tool needs to be installed on the target machine.
+'''),
+
+    ('payload_compression_level', False, int, '''
+Compression level used for `payload_compression`.  Defaults to 9 for "bz2",
+6 for "xz" and 3 for "zstd".
+'''),
+
+    ('payload_compression_threads', False, int, '''
+Number of threads used for `payload_compression`.  Defaults to the number of
+CPUs.
 '''),
 
     ('license_file',           False, str, '''
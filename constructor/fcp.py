@@ -8,15 +8,33 @@ fcp (fetch conda packages) module
 """
 from __future__ import absolute_import, division, print_function
 
+from array import array
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import json
+from multiprocessing import cpu_count
 from os.path import getsize, isdir, isfile, islink, join
 import sys
 
-from constructor.utils import md5_files
-from .conda_interface import (PackageCacheData, PackageCacheRecord, Solver, concatv, conda_context,
-                              conda_replace_context_default, download, env_vars, groupby, read_paths_json,
-                              all_channel_urls)
+try:
+    from sys import intern
+except ImportError:  # Python 2, where intern() only accepts str, not unicode paths
+    def intern(s):
+        return s
+
+from .cache import (DigestIndex, read_manifest, read_solve_cache, solve_cache_key,
+                    write_manifest, write_solve_cache)
+from .conda_interface import (CONDA_INTERFACE_VERSION, Channel, PackageCacheData,
+                              PackageCacheRecord, PackageRecord, Solver, SubdirData, concatv,
+                              conda_context, conda_replace_context_default, download, env_vars,
+                              extract_tarball, groupby, PathType, read_paths_json,
+                              repodata_stamps, all_channel_urls)
+from .utils import hash_files, write_file_atomic
+
+# number of packages downloaded concurrently, unless set by `fetch_workers`
+DEFAULT_FETCH_WORKERS = 4
+# number of packages extracted concurrently, unless set by `extract_workers`
+DEFAULT_EXTRACT_WORKERS = cpu_count()
 
 
 def warn_menu_packages_missing(precs, menu_packages):
@@ -66,106 +84,307 @@ platform: %(platform)s""" % dict(
     print()
 
 
-def _fetch(download_dir, precs):
+def _package_paths(download_dir, prec):
+    package_tarball_full_path = join(download_dir, prec.fn)
+    if package_tarball_full_path.endswith(".tar.bz2"):
+        extracted_package_dir = package_tarball_full_path[:-8]
+    elif package_tarball_full_path.endswith(".conda"):
+        extracted_package_dir = package_tarball_full_path[:-6]
+    return package_tarball_full_path, extracted_package_dir
+
+
+def _read_text(path):
+    try:
+        with open(path) as fi:
+            return fi.read()
+    except (IOError, OSError):
+        return None
+
+
+def _digests_match(digests, prec):
+    # sha256 and size are not available in the repodata of all channels
+    sha256 = getattr(prec, 'sha256', None)
+    size = getattr(prec, 'size', None)
+    return (digests['md5'] == prec.md5 and (not sha256 or digests['sha256'] == sha256) and
+            (not size or digests['size'] == size))
+
+
+def _download(download_dir, prec, digest_index):
+    package_tarball_full_path, _ = _package_paths(download_dir, prec)
+    sha256 = getattr(prec, 'sha256', None)
+    algorithms = ('md5', 'sha256') if sha256 else ('md5',)
+
+    if not (isfile(package_tarball_full_path)
+            and _digests_match(digest_index.digests(package_tarball_full_path, algorithms),
+                               prec)):
+        print('fetching: %s' % prec.fn)
+        # the name of the md5 keyword of download() differs between conda
+        # versions, so the file is verified here instead
+        download(prec.url, package_tarball_full_path)
+        # a single pass for all digests, such that the index entry is complete
+        digests = hash_files([package_tarball_full_path])
+        if not _digests_match(digests, prec):
+            raise RuntimeError("checksum mismatch of downloaded file: %s" % prec.url)
+        # only verified files are recorded, as the index is trusted by later builds
+        digest_index.add(package_tarball_full_path, digests)
+
+
+def _extract_executor(workers):
+    """
+    Return the process pool used to extract the packages.  Its worker
+    processes are started while the download threads are running, and a
+    process forked while other threads hold locks can deadlock, so the workers
+    are not forked from this process.
+    """
+    try:
+        from multiprocessing import get_context
+        mp_context = get_context('spawn' if sys.platform == 'win32' else 'forkserver')
+        return ProcessPoolExecutor(workers, mp_context=mp_context)
+    except (ImportError, TypeError, ValueError):
+        # Python < 3.7, where all worker processes are started on the first
+        # submit, so start them before any download thread exists
+        executor = ProcessPoolExecutor(workers)
+        executor.submit(int).result()
+        return executor
+
+
+def _fetch(download_dir, precs, fetch_workers=DEFAULT_FETCH_WORKERS,
+           extract_workers=DEFAULT_EXTRACT_WORKERS, verify_cache=False, verbose=False):
     assert conda_context.pkgs_dirs[0] == download_dir
     pc = PackageCacheData(download_dir)
     assert pc.is_writable
 
+    # digests of the cached tarballs, such that warm builds only stat them
+    digest_index = DigestIndex(download_dir, verify=verify_cache)
+    errors = {}
+    with _extract_executor(extract_workers) as extract_executor, \
+            ThreadPoolExecutor(fetch_workers) as fetch_executor:
+        download_futures = {fetch_executor.submit(_download, download_dir, prec, digest_index): prec
+                            for prec in precs}
+        extract_futures = {}
+        # extract each package as soon as its download is complete, while
+        # the remaining downloads are still running
+        for future in as_completed(download_futures):
+            prec = download_futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                errors[prec.fn] = e
+                continue
+            package_tarball_full_path, extracted_package_dir = _package_paths(download_dir, prec)
+            if not isdir(extracted_package_dir):
+                future = extract_executor.submit(extract_tarball, package_tarball_full_path,
+                                                 extracted_package_dir)
+                extract_futures[future] = prec
+
+        for future in as_completed(extract_futures):
+            prec = extract_futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                errors[prec.fn] = e
+
+    digest_index.save()
+
+    if errors:
+        # report in solver order, not in the (random) order of completion
+        sys.exit("Error: could not fetch the following packages:\n%s" % '\n'.join(
+            '    %s: %s' % (prec.fn, errors[prec.fn]) for prec in precs if prec.fn in errors))
+
+    # Only the records of the given packages are returned, in solver order.  The
+    # package cache directory can hold many more packages from earlier builds,
+    # which is why the records are not inserted into (and thereby loading) `pc`.
+    pc_recs = []
+    n_rewrites = 0
     for prec in precs:
-        package_tarball_full_path = join(download_dir, prec.fn)
-        if package_tarball_full_path.endswith(".tar.bz2"):
-            extracted_package_dir = package_tarball_full_path[:-8]
-        elif package_tarball_full_path.endswith(".conda"):
-            extracted_package_dir = package_tarball_full_path[:-6]
-
-        if not (isfile(package_tarball_full_path)
-                and md5_files([package_tarball_full_path]) == prec.md5):
-            print('fetching: %s' % prec.fn)
-            download(prec.url, join(download_dir, prec.fn))
-
-        if not isdir(extracted_package_dir):
-            from conda.gateways.disk.create import extract_tarball
-            extract_tarball(package_tarball_full_path, extracted_package_dir)
+        package_tarball_full_path, extracted_package_dir = _package_paths(download_dir, prec)
 
         repodata_record_path = join(extracted_package_dir, 'info', 'repodata_record.json')
+        data = json.dumps(prec.dump(), indent=2, sort_keys=True, separators=(',', ': '))
+        # leave unchanged files alone, which keeps their mtime
+        if _read_text(repodata_record_path) != data:
+            write_file_atomic(repodata_record_path, data)
+            n_rewrites += 1
 
-        with open(repodata_record_path, "w") as fh:
-            json.dump(prec.dump(), fh, indent=2, sort_keys=True, separators=(',', ': '))
-
-        package_cache_record = PackageCacheRecord.from_objects(
+        pc_recs.append(PackageCacheRecord.from_objects(
             prec,
             package_tarball_full_path=package_tarball_full_path,
             extracted_package_dir=extracted_package_dir,
-        )
-        pc.insert(package_cache_record)
-
-    return tuple(pc.iter_records())
+        ))
 
-
-def check_duplicates_files(pc_recs, platform, ignore_duplicate_files=False):
+    if verbose:
+        print("updated %d of %d repodata_record.json files" % (n_rewrites, len(precs)))
+    return tuple(pc_recs)
+
+
+def _path_collisions(paths):
+    """
+    Yield the groups of indices into `paths`, for which the paths are equal
+    when ignoring case, for all groups with more than one member.
+    """
+    # a single sort makes all colliding paths, case-sensitive or not, adjacent
+    keyed = sorted((path.lower(), k) for k, path in enumerate(paths))
+    start = 0
+    for end in range(1, len(keyed) + 1):
+        if end == len(keyed) or keyed[end][0] != keyed[start][0]:
+            if end - start > 1:
+                yield [k for _, k in keyed[start:end]]
+            start = end
+
+
+def _report_duplicates(msg_str, error):
+    if error:
+        sys.exit('Error: {}'.format(msg_str))
+    print('Warning: {}'.format(msg_str))
+
+
+def _scan_package(pc_rec):
+    """
+    Return the paths of the extracted package `pc_rec` and their total size.
+    """
+    extracted_package_dir = pc_rec.extracted_package_dir
+    # extracted packages never change, so the result is stored along with
+    # the package, and only recomputed when the package itself was replaced
+    manifest = read_manifest(extracted_package_dir, pc_rec.md5)
+    if manifest is not None:
+        return manifest
+
+    paths = []
+    size = 0
+    for path_data in read_paths_json(extracted_package_dir).paths:
+        short_path = path_data.path
+        paths.append(short_path)
+        if path_data.path_type == PathType.softlink:
+            continue
+        # only packages without info/paths.json lack the size, which is then
+        # taken from the file system
+        size_in_bytes = getattr(path_data, 'size_in_bytes', None)
+        if size_in_bytes is None:
+            full_path = join(extracted_package_dir, short_path)
+            if islink(full_path):
+                continue
+            size_in_bytes = getsize(full_path)
+        size += size_in_bytes
+
+    write_manifest(extracted_package_dir, pc_rec.md5, paths, size)
+    return paths, size
+
+
+def check_duplicates_files(pc_recs, platform, ignore_duplicate_files=False,
+                           workers=DEFAULT_FETCH_WORKERS):
     print('Checking for duplicate files ...')
 
-    map_members_scase = defaultdict(set)
-    map_members_icase = defaultdict(lambda: {'files': set(), 'fns': set()})
+    # every path of every package is stored once, along with the index of
+    # its package in `fns`
+    fns = []
+    paths = []
+    owners = array('I')
 
     # Keep a min, 50MB buffer size
     total_tarball_size = 52428800
     total_extracted_pkgs_size = 52428800
 
-    for pc_rec in pc_recs:
-        fn = pc_rec.fn
-        extracted_package_dir = pc_rec.extracted_package_dir
-
-        total_tarball_size += int(pc_rec.get("size", 0))
-
-        paths_data = read_paths_json(extracted_package_dir).paths
-        for path_data in paths_data:
-            short_path = path_data.path
-            if islink(join(extracted_package_dir, short_path)):
-                 size = 0
-            else:
-                try:
-                    size = (path_data.size_in_bytes or
-                            getsize(join(extracted_package_dir, short_path)))
-                except AttributeError:
-                    size = getsize(join(extracted_package_dir, short_path))
+    with ThreadPoolExecutor(workers) as executor:
+        for pc_rec, (package_paths, size) in zip(pc_recs, executor.map(_scan_package, pc_recs)):
+            fns.append(pc_rec.fn)
+            package_id = len(fns) - 1
+            total_tarball_size += int(pc_rec.get("size", 0))
             total_extracted_pkgs_size += size
-
-            map_members_scase[short_path].add(fn)
-
-            short_path_lower = short_path.lower()
-            map_members_icase[short_path_lower]['files'].add(short_path)
-            map_members_icase[short_path_lower]['fns'].add(fn)
-
-    for member in map_members_scase:
-        fns = map_members_scase[member]
-        msg_str = "File '%s' found in multiple packages: %s" % (
-                  member, ', '.join(fns))
-        if len(fns) > 1:
-            if ignore_duplicate_files:
-                print('Warning: {}'.format(msg_str))
-            else:
-                sys.exit('Error: {}'.format(msg_str))
-
-    for member in map_members_icase:
-        # Some filesystems are not case sensitive by default (e.g HFS)
-        # Throw warning on linux and error out on macOS/windows
-        fns = map_members_icase[member]['fns']
-        files = list(map_members_icase[member]['files'])
-        msg_str = "Files %s found in the package(s): %s" % (
-                   str(files)[1:-1], ', '.join(fns))
-        if len(files) > 1:
-            if ignore_duplicate_files or platform.startswith('linux'):
-                print('Warning: {}'.format(msg_str))
-            else:
-                sys.exit('Error: {}'.format(msg_str))
+            for short_path in package_paths:
+                paths.append(intern(short_path))
+                owners.append(package_id)
+
+    for group in _path_collisions(paths):
+        members = defaultdict(set)
+        for k in group:
+            members[paths[k]].add(owners[k])
+
+        for member in sorted(members):
+            package_ids = members[member]
+            if len(package_ids) > 1:
+                msg_str = "File '%s' found in multiple packages: %s" % (
+                          member, ', '.join(fns[i] for i in sorted(package_ids)))
+                _report_duplicates(msg_str, not ignore_duplicate_files)
+
+        if len(members) > 1:
+            # Some filesystems are not case sensitive by default (e.g HFS)
+            # Throw warning on linux and error out on macOS/windows
+            package_ids = set(owners[k] for k in group)
+            msg_str = "Files %s found in the package(s): %s" % (
+                       str(sorted(members))[1:-1],
+                       ', '.join(fns[i] for i in sorted(package_ids)))
+            _report_duplicates(msg_str, not (ignore_duplicate_files or
+                                             platform.startswith('linux')))
 
     return total_tarball_size, total_extracted_pkgs_size
 
 
+def _repodata_stamps(channel_urls, subdirs, refresh=True):
+    """
+    Return the stamps of the repodata files read by the solver for all
+    channels and subdirs, see `conda_interface.repodata_stamps()`.
+    """
+    return [(url,) + stamp
+            for url in all_channel_urls(channel_urls, subdirs=subdirs)
+            for stamp in repodata_stamps(url, refresh)]
+
+
+def _repodata_paths(channel_urls, subdirs):
+    """
+    Return a dict mapping the urls of all channels and subdirs to the path of
+    the repodata loaded in this process, i.e. by the solver, which is in
+    conda's cache directory.
+    """
+    paths = {}
+    for url in all_channel_urls(channel_urls, subdirs=subdirs):
+        # the instances are cached, so this is the one used by the solver
+        subdir_data = SubdirData(Channel(url))
+        cache_path = subdir_data.cache_path_json
+        if getattr(subdir_data, '_loaded', False) and isfile(cache_path):
+            paths[url] = cache_path
+    return paths
+
+
+def _solve(download_dir, platform, channel_urls, specs, solve_cache=True, verbose=True):
+    """
+    Return the package records of the solve, and the paths of the repodata
+    loaded by the solver, see `_repodata_paths()`.  No paths are returned when
+    the records were taken from the solve cache.
+    """
+    subdirs = (platform, "noarch")
+    if solve_cache:
+        # the exclusions are applied to the result of the solve, so they are
+        # not part of the key
+        key = solve_cache_key(CONDA_INTERFACE_VERSION, specs, channel_urls, subdirs,
+                              _repodata_stamps(channel_urls, subdirs))
+        records = read_solve_cache(download_dir, key)
+        if verbose:
+            print("solve cache: %s (%s)" % ('miss' if records is None else 'hit', key))
+        if records is not None:
+            return [PackageRecord(**record) for record in records], {}
+
+    solver = Solver(
+        # The Solver class doesn't do well with `None` as a prefix right now
+        prefix="/constructor/no-environment",
+        channels=channel_urls,
+        subdirs=subdirs,
+        specs_to_add=specs,
+    )
+    precs = list(solver.solve_final_state())
+    if solve_cache:
+        # the stamps of the repodata as refreshed by the solver, such that the
+        # next lookup finds the result, unless the repodata changed again
+        key = solve_cache_key(CONDA_INTERFACE_VERSION, specs, channel_urls, subdirs,
+                              _repodata_stamps(channel_urls, subdirs, refresh=False))
+        write_solve_cache(download_dir, key, [prec.dump() for prec in precs])
+    return precs, _repodata_paths(channel_urls, subdirs)
+
+
 def _main(name, version, download_dir, platform, channel_urls=(), channels_remap=(), specs=(),
           exclude=(), menu_packages=(), install_in_dependency_order=True,
-          ignore_duplicate_files=False, verbose=True, dry_run=False):
+          ignore_duplicate_files=False, verbose=True, dry_run=False,
+          fetch_workers=DEFAULT_FETCH_WORKERS, extract_workers=DEFAULT_EXTRACT_WORKERS,
+          verify_cache=False, solve_cache=True):
 
     # Add python to specs, since all installers need a python interpreter. In the future we'll
     # probably want to add conda too.
@@ -179,14 +398,8 @@ def _main(name, version, download_dir, platform, channel_urls=(), channels_remap
         (x['src'] for x in channels_remap),
     ))
 
-    solver = Solver(
-        # The Solver class doesn't do well with `None` as a prefix right now
-        prefix="/constructor/no-environment",
-        channels=channel_urls,
-        subdirs=(platform, "noarch"),
-        specs_to_add=specs,
-    )
-    precs = list(solver.solve_final_state())
+    precs, repodata_paths = _solve(download_dir, platform, channel_urls, specs, solve_cache,
+                                   verbose)
 
     if not install_in_dependency_order:
         precs = sorted(precs, key="name")
@@ -206,21 +419,17 @@ def _main(name, version, download_dir, platform, channel_urls=(), channels_remap
     if dry_run:
         return
 
-    pc_recs = _fetch(download_dir, precs)
-    # Constructor cache directory can have multiple packages from different
-    # installer creations. Filter out those which the solver picked.
-    precs_fns = [x.fn for x in precs]
-    pc_recs = [x for x in pc_recs if x.fn in precs_fns]
+    pc_recs = _fetch(download_dir, precs, fetch_workers, extract_workers, verify_cache, verbose)
 
     _urls = [(pc_rec.url, pc_rec.md5) for pc_rec in pc_recs]
 
     approx_tarballs_size, approx_pkgs_size = check_duplicates_files(
-        pc_recs, platform, ignore_duplicate_files
+        pc_recs, platform, ignore_duplicate_files, fetch_workers
     )
 
     dists = list(prec.fn for prec in precs)
 
-    return _urls, dists, approx_tarballs_size, approx_pkgs_size
+    return _urls, dists, approx_tarballs_size, approx_pkgs_size, repodata_paths
 
 
 def main(info, verbose=True, dry_run=False):
@@ -235,20 +444,30 @@ def main(info, verbose=True, dry_run=False):
     menu_packages = info.get("menu_packages", ())
     install_in_dependency_order = info.get("install_in_dependency_order", True)
     ignore_duplicate_files = info.get("ignore_duplicate_files", False)
+    fetch_workers = info.get("fetch_workers", DEFAULT_FETCH_WORKERS)
+    extract_workers = info.get("extract_workers", DEFAULT_EXTRACT_WORKERS)
+    verify_cache = info.get("_verify_cache", False)
+    solve_cache = not info.get("_no_solve_cache", False)
 
     if not channel_urls and not channels_remap:
         sys.exit("Error: at least one entry in 'channels' or 'channels_remap' is required")
 
+    for key, workers in ('fetch_workers', fetch_workers), ('extract_workers', extract_workers):
+        if workers < 1:
+            sys.exit("Error: '%s' must be at least 1, got %d" % (key, workers))
+
     with env_vars({
         "CONDA_PKGS_DIRS": download_dir,
     }, conda_replace_context_default):
-        _urls, dists, approx_tarballs_size, approx_pkgs_size = _main(
+        _urls, dists, approx_tarballs_size, approx_pkgs_size, repodata_paths = _main(
             name, version, download_dir, platform, channel_urls, channels_remap, specs,
               exclude, menu_packages, install_in_dependency_order,
-              ignore_duplicate_files, verbose, dry_run
+              ignore_duplicate_files, verbose, dry_run, fetch_workers, extract_workers,
+              verify_cache, solve_cache
         )
 
     info["_urls"] = _urls
     info["_dists"] = dists
     info["_approx_tarballs_size"] = approx_tarballs_size
     info["_approx_pkgs_size"] = approx_pkgs_size
+    info["_repodata_paths"] = repodata_paths
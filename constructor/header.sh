@@ -5,6 +5,7 @@
 # PLAT:  __PLAT__
 # LINES: @LINES@
 # MD5:   __MD5__
+# SHA256: __SHA256__
 
 #if osx
 unset DYLD_LIBRARY_PATH
@@ -66,6 +67,7 @@ FORCE=0
 SKIP_SCRIPTS=0
 TEST=0
 REINSTALL=0
+JOBS=1
 USAGE="
 usage: $0 [options]
 
@@ -75,6 +77,8 @@ Installs __NAME__ __VERSION__
              it is expected the license terms are agreed upon
 -f           no error if install prefix already exists
 -h           print this help message and exit
+-j JOBS      number of processes unpacking the conda packages in parallel,
+             defaults to $JOBS
 -p PREFIX    install prefix, defaults to $PREFIX, must not contain spaces.
 -s           skip running pre/post-link/install scripts
 -u           update an existing installation
@@ -82,7 +86,7 @@ Installs __NAME__ __VERSION__
 "
 
 if which getopt > /dev/null 2>&1; then
-    OPTS=$(getopt bfhp:sut "$*" 2>/dev/null)
+    OPTS=$(getopt bfhj:p:sut "$*" 2>/dev/null)
     if [ ! $? ]; then
         printf "%s\\n" "$USAGE"
         exit 2
@@ -104,6 +108,11 @@ if which getopt > /dev/null 2>&1; then
                 FORCE=1
                 shift
                 ;;
+            -j)
+                JOBS="$2"
+                shift
+                shift
+                ;;
             -p)
                 PREFIX="$2"
                 shift
@@ -132,7 +141,7 @@ if which getopt > /dev/null 2>&1; then
         esac
     done
 else
-    while getopts "bfhp:sut" x; do
+    while getopts "bfhj:p:sut" x; do
         case "$x" in
             h)
                 printf "%s\\n" "$USAGE"
@@ -144,6 +153,9 @@ else
             f)
                 FORCE=1
                 ;;
+            j)
+                JOBS="$OPTARG"
+                ;;
             p)
                 PREFIX="$OPTARG"
                 ;;
@@ -337,17 +349,31 @@ export PREFIX
 
 printf "PREFIX=%s\\n" "$PREFIX"
 
-# verify the MD5 sum of the tarball appended to this header
+# verify the checksum of the payload appended to this header, using sha256
+# when available, and md5 otherwise
+#if osx
+SUM_CMD="shasum -a 256"
+#else
+SUM_CMD="sha256sum -"
+#endif
+if command -v ${SUM_CMD%% *} > /dev/null 2>&1; then
+    SUM_NAME=sha256
+    SUM_EXPECTED=__SHA256__
+else
+    SUM_NAME=md5
+    SUM_EXPECTED=__MD5__
 #if osx
-MD5=$(tail -n +@LINES@ "$THIS_PATH" | md5)
+    SUM_CMD="md5"
 #else
-MD5=$(tail -n +@LINES@ "$THIS_PATH" | md5sum -)
+    SUM_CMD="md5sum -"
 #endif
+fi
+SUM=$(dd if="$THIS_PATH" bs=@BLOCK_SIZE@ skip=@CON_EXE_BLOCK_OFFSET@ 2>/dev/null | $SUM_CMD)
 
-if ! echo "$MD5" | grep __MD5__ >/dev/null; then
-    printf "WARNING: md5sum mismatch of tar archive\\n" >&2
-    printf "expected: __MD5__\\n" >&2
-    printf "     got: %s\\n" "$MD5" >&2
+if ! echo "$SUM" | grep "$SUM_EXPECTED" >/dev/null; then
+    printf "WARNING: %s mismatch of tar archive\\n" "$SUM_NAME" >&2
+    printf "expected: %s\\n" "$SUM_EXPECTED" >&2
+    printf "     got: %s\\n" "$SUM" >&2
 fi
 
 # extract the tarball appended to this header, this creates the *.tar.bz2 files
@@ -358,28 +384,88 @@ cd "$PREFIX"
 unset PYTHON_SYSCONFIGDATA_NAME _CONDA_PYTHON_SYSCONFIGDATA_NAME
 
 CONDA_EXEC="$PREFIX/conda.exe"
-# 3-part dd from https://unix.stackexchange.com/a/121798/34459
-# this is similar below with the tarball payload - see shar.py in constructor to see how
-#    these values are computed.
-{
-    dd if="$THIS_PATH" bs=1 skip=@CON_EXE_OFFSET_BYTES@ count=@CON_EXE_START_REMAINDER@ 2>/dev/null
-    dd if="$THIS_PATH" bs=@BLOCK_SIZE@ skip=@CON_EXE_BLOCK_OFFSET@ count=@CON_EXE_SIZE_BLOCKS@ 2>/dev/null
-    dd if="$THIS_PATH" bs=1 skip=@CON_EXE_REMAINDER_OFFSET@ count=@CON_EXE_END_REMAINDER@ 2>/dev/null
-} > "$CONDA_EXEC"
+# the payloads are aligned to blocks, and conda.exe is padded to full blocks,
+#    see shar.py in constructor to see how these values are computed.
+dd if="$THIS_PATH" bs=@BLOCK_SIZE@ skip=@CON_EXE_BLOCK_OFFSET@ count=@CON_EXE_SIZE_BLOCKS@ 2>/dev/null | \
+    head -c @CON_EXE_SIZE_BYTES@ > "$CONDA_EXEC"
 
 chmod +x "$CONDA_EXEC"
 
 export TMP_BACKUP="$TMP"
 export TMP=$PREFIX/install_tmp
 
-printf "Unpacking payload ...\n"
-{
-    dd if="$THIS_PATH" bs=1 skip=@TARBALL_OFFSET_BYTES@ count=@TARBALL_START_REMAINDER@ 2>/dev/null
-    dd if="$THIS_PATH" bs=@BLOCK_SIZE@ skip=@TARBALL_BLOCK_OFFSET@ count=@TARBALL_SIZE_BLOCKS@ 2>/dev/null
-    dd if="$THIS_PATH" bs=1 skip=@TARBALL_REMAINDER_OFFSET@ count=@TARBALL_END_REMAINDER@ 2>/dev/null
-} | "$CONDA_EXEC" constructor --extract-tar --prefix "$PREFIX"
+#if payload_compression == 'none'
+DECOMPRESS="cat"
+#endif
+#if payload_compression == 'bz2'
+# prefer parallel decompressors
+if command -v lbzip2 > /dev/null 2>&1; then
+    DECOMPRESS="lbzip2 -dc"
+elif command -v pbzip2 > /dev/null 2>&1; then
+    DECOMPRESS="pbzip2 -dc"
+else
+    DECOMPRESS="bzip2 -dc"
+fi
+#endif
+#if payload_compression == 'xz'
+# multi-threaded decompression needs xz >= 5.4, older versions may not know -T
+if xz -T0 --version > /dev/null 2>&1; then
+    DECOMPRESS="xz -dc -T0"
+else
+    DECOMPRESS="xz -dc"
+fi
+#endif
+#if payload_compression == 'zstd'
+DECOMPRESS="zstd -dc -q"
+#endif
+if ! command -v ${DECOMPRESS%% *} > /dev/null 2>&1; then
+    printf "ERROR: '%s' is required to unpack the payload\\n" "${DECOMPRESS%% *}" >&2
+    exit 1
+fi
 
-"$CONDA_EXEC" constructor --prefix "$PREFIX" --extract-conda-pkgs || exit 1
+printf "Unpacking payload ...\n"
+dd if="$THIS_PATH" bs=@BLOCK_SIZE@ skip=@TARBALL_BLOCK_OFFSET@ 2>/dev/null | \
+    $DECOMPRESS | "$CONDA_EXEC" constructor --extract-tar --prefix "$PREFIX"
+
+if [ "$JOBS" -gt 1 ] 2>/dev/null; then
+    # Distribute the conda packages, largest first, over JOBS sub-prefixes,
+    # which are unpacked by one conda.exe process each, and move them back
+    # once all of them are done.
+    EXTRACT_DIR="$PREFIX/install_tmp/extract"
+    rm -rf "$EXTRACT_DIR"
+    i=0
+    for pkg in $(cd "$PREFIX/pkgs" && ls -S -- *.tar.bz2 *.conda 2>/dev/null); do
+        mkdir -p "$EXTRACT_DIR/$((i % JOBS))/pkgs" || exit 1
+        mv "$PREFIX/pkgs/$pkg" "$EXTRACT_DIR/$((i % JOBS))/pkgs/" || exit 1
+        i=$((i + 1))
+    done
+    PIDS=""
+    for shard in "$EXTRACT_DIR"/*; do
+        [ -d "$shard" ] || continue
+        "$CONDA_EXEC" constructor --prefix "$shard" --extract-conda-pkgs &
+        PIDS="$PIDS $!"
+    done
+    EXTRACT_STATUS=0
+    for pid in $PIDS; do
+        wait "$pid" || EXTRACT_STATUS=1
+    done
+    for shard in "$EXTRACT_DIR"/*; do
+        [ -d "$shard" ] || continue
+        for entry in "$shard"/pkgs/*; do
+            [ -e "$entry" ] || continue
+            # replace the package extracted by an earlier installation (-u)
+            rm -rf "$PREFIX/pkgs/${entry##*/}"
+            if ! mv "$entry" "$PREFIX/pkgs/"; then
+                printf "ERROR: could not move %s to %s\\n" "$entry" "$PREFIX/pkgs" >&2
+                exit 1
+            fi
+        done
+    done
+    rm -rf "$EXTRACT_DIR"
+    [ "$EXTRACT_STATUS" = "0" ] || exit 1
+else
+    "$CONDA_EXEC" constructor --prefix "$PREFIX" --extract-conda-pkgs || exit 1
+fi
 
 PRECONDA="$PREFIX/preconda.tar.bz2"
 "$CONDA_EXEC" constructor --prefix "$PREFIX" --extract-tarball < "$PRECONDA" || exit 1
@@ -25,8 +25,10 @@ import os
 import re
 import sys
 import json
+import mmap
 import shutil
 import stat
+import tempfile
 from os.path import abspath, dirname, exists, isdir, isfile, islink, join
 from optparse import OptionParser
 
@@ -52,6 +54,14 @@ ROOT_PREFIX = sys.prefix
 PKGS_DIR = join(ROOT_PREFIX, 'pkgs')
 SKIP_SCRIPTS = False
 IDISTS = {}
+try:
+    from multiprocessing import cpu_count
+    WORKERS = cpu_count()
+except (ImportError, NotImplementedError):
+    WORKERS = 1
+
+# chunk size used when copying (large) files
+COPY_CHUNK_SIZE = 2 ** 20
 
 
 def _link(src, dst, linktype=LINK_HARD):
@@ -162,52 +172,161 @@ def binary_replace(data, a, b):
     replaced with `b` and the remaining string is padded with null characters.
     All input arguments are expected to be bytes objects.
     """
-    def replace(match):
-        occurances = match.group().count(a)
+    res = []
+    pos = 0
+    while True:
+        start = data.find(a, pos)
+        if start == -1:
+            break
+        end = data.find(b'\0', start + len(a))
+        if end == -1:
+            break
+        end += 1
+        # the null terminated string containing the placeholder(s)
+        string = data[start:end]
+        occurances = string.count(a)
         padding = (len(a) - len(b)) * occurances
         if padding < 0:
             raise PaddingError(a, b, padding)
-        return match.group().replace(a, b) + b'\0' * padding
-
-    pat = re.compile(re.escape(a) + b'([^\0]*?)\0')
-    res = pat.sub(replace, data)
+        res.append(data[pos:start])
+        res.append(string.replace(a, b))
+        res.append(b'\0' * padding)
+        pos = end
+    if not res:
+        return data
+    res.append(data[pos:])
+    res = b''.join(res)
     assert len(res) == len(data)
     return res
 
 
+def _copy_mmap(mm, fo, start, stop):
+    # copy mm[start:stop] to `fo`, in chunks of at most COPY_CHUNK_SIZE bytes
+    while start < stop:
+        n = min(stop, start + COPY_CHUNK_SIZE)
+        fo.write(mm[start:n])
+        start = n
+
+
+def binary_replace_copy(mm, fo, a, b):
+    """
+    Write the content of the memory map `mm` to the file object `fo`, with
+    the replacement of `binary_replace()` applied.  Only the null terminated
+    strings containing the placeholder `a` are read into memory at once.
+    """
+    pos = 0
+    while True:
+        found = mm.find(a, pos)
+        end = -1 if found == -1 else mm.find(b'\0', found + len(a))
+        if end == -1:
+            _copy_mmap(mm, fo, pos, len(mm))
+            return
+        end += 1
+        _copy_mmap(mm, fo, pos, found)
+        fo.write(binary_replace(mm[found:end], a, b))
+        pos = end
+
+
+def text_replace_copy(mm, fo, a, b):
+    """
+    Write the content of the memory map `mm` to the file object `fo`, where
+    all occurrences of `a` are replaced with `b`.
+    """
+    pos = 0
+    while True:
+        found = mm.find(a, pos)
+        if found == -1:
+            _copy_mmap(mm, fo, pos, len(mm))
+            return
+        _copy_mmap(mm, fo, pos, found)
+        fo.write(b)
+        pos = found + len(a)
+
+
 def update_prefix(path, new_prefix, placeholder, mode):
     if on_win:
         # force all prefix replacements to forward slashes to simplify need
         # to escape backslashes - replace with unix-style path separators
         new_prefix = new_prefix.replace('\\', '/')
 
-    path = os.path.realpath(path)
-    with open(path, 'rb') as fi:
-        data = fi.read()
-    if mode == 'text':
-        new_data = data.replace(placeholder.encode('utf-8'),
-                                new_prefix.encode('utf-8'))
-    elif mode == 'binary':
-        if on_win:
-            # anaconda-verify will not allow binary placeholder on Windows.
-            # However, since some packages might be created wrong (and a
-            # binary placeholder would break the package, we just skip here.
-            return
-        new_data = binary_replace(data, placeholder.encode('utf-8'),
-                                  new_prefix.encode('utf-8'))
-    else:
-        sys.exit("Invalid mode:" % mode)
+    if mode == 'binary' and on_win:
+        # anaconda-verify will not allow binary placeholder on Windows.
+        # However, since some packages might be created wrong (and a
+        # binary placeholder would break the package, we just skip here.
+        return
+    if mode not in ('text', 'binary'):
+        sys.exit("Invalid mode: %s" % mode)
 
-    if new_data == data:
+    path = os.path.realpath(path)
+    a = placeholder.encode('utf-8')
+    b = new_prefix.encode('utf-8')
+    # empty files cannot be memory mapped, and have nothing to replace
+    if a == b or os.path.getsize(path) == 0:
         return
     st = os.lstat(path)
+
+    # The file is memory mapped, and the new content is streamed into a
+    # temporary file, such that the memory used does not depend on the size
+    # of the file.  The file is then replaced, and never modified in place,
+    # as it may be mapped or running, or a hard link.
+    with open(path, 'rb') as fi:
+        mm = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if mm.find(a) == -1:
+                return
+            fd, tmp_path = tempfile.mkstemp(dir=dirname(path))
+            written = False
+            try:
+                with os.fdopen(fd, 'wb') as fo:
+                    if mode == 'text':
+                        text_replace_copy(mm, fo, a, b)
+                    else:
+                        binary_replace_copy(mm, fo, a, b)
+                written = True
+            finally:
+                if not written:
+                    os.unlink(tmp_path)
+        finally:
+            mm.close()
+
     # unlink in case the file is memory mapped
     exp_backoff_fn(os.unlink, path)
-    with open(path, 'wb') as fo:
-        fo.write(new_data)
+    os.rename(tmp_path, path)
     os.chmod(path, stat.S_IMODE(st.st_mode))
 
 
+def update_prefix_files(prefix, has_prefix_files, workers=None):
+    """
+    Update the prefix in all files of `has_prefix_files`, which maps paths
+    (relative to `prefix`) to tuples(placeholder, mode), using up to
+    `workers` threads (WORKERS by default).  Return the list of
+    tuples(path, exception) of the files which could not be updated, sorted
+    by path, i.e. independent of the order in which the threads finish.
+    """
+    def update(f):
+        placeholder, mode = has_prefix_files[f]
+        try:
+            update_prefix(join(prefix, f), prefix, placeholder, mode)
+        except (Exception, SystemExit) as e:
+            # SystemExit would otherwise kill the worker thread of the pool
+            return f, e
+
+    files = sorted(has_prefix_files)
+    workers = min(WORKERS if workers is None else workers, len(files))
+    if workers > 1:
+        from multiprocessing.pool import ThreadPool
+
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(update, files)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [update(f) for f in files]
+    return [res for res in results if res is not None]
+
+
 def name_dist(dist):
     if hasattr(dist, 'name'):
         return dist.name
@@ -320,6 +439,17 @@ def link(prefix, dist, linktype=LINK_HARD, info_dir=None):
       - <PKGS_DIR>/dist
       - <ROOT_PREFIX>/ (when the linktype is None)
     '''
+    files = place_files(prefix, dist, linktype, info_dir)
+    finish_link(prefix, dist, files, linktype, info_dir)
+
+
+def place_files(prefix, dist, linktype=LINK_HARD, info_dir=None,
+                workers=None):
+    """
+    First part of link(): place the files of the package in the prefix (when
+    linktype is not None) and update the prefix in them, using up to
+    `workers` threads (WORKERS by default).  Return the list of files.
+    """
     if linktype:
         source_dir = join(PKGS_DIR, dist)
         info_dir = join(source_dir, 'info')
@@ -337,7 +467,12 @@ def link(prefix, dist, linktype=LINK_HARD, info_dir=None):
             dst = join(prefix, f)
             dst_dir = dirname(dst)
             if not isdir(dst_dir):
-                os.makedirs(dst_dir)
+                try:
+                    os.makedirs(dst_dir)
+                except OSError:
+                    # created by another package being placed concurrently
+                    if not isdir(dst_dir):
+                        raise
             if exists(dst):
                 if FORCE:
                     rm_rf(dst)
@@ -351,13 +486,29 @@ def link(prefix, dist, linktype=LINK_HARD, info_dir=None):
             except OSError:
                 pass
 
-    for f in sorted(has_prefix_files):
-        placeholder, mode = has_prefix_files[f]
-        try:
-            update_prefix(join(prefix, f), prefix, placeholder, mode)
-        except PaddingError:
+    errors = update_prefix_files(prefix, has_prefix_files, workers)
+    if errors:
+        # the error of the first file, as when updating one file at a time
+        f, e = errors[0]
+        if isinstance(e, PaddingError):
             sys.exit("ERROR: placeholder '%s' too short in: %s\n" %
-                     (placeholder, dist))
+                     (has_prefix_files[f][0], dist))
+        if isinstance(e, EnvironmentError) and e.filename is None:
+            e.filename = join(prefix, f)
+        raise e
+    return files
+
+
+def finish_link(prefix, dist, files, linktype=LINK_HARD, info_dir=None):
+    """
+    Second part of link(): run the post-link script of the package, and
+    create its conda metadata.
+    """
+    if linktype:
+        source_dir = join(PKGS_DIR, dist)
+        info_dir = join(source_dir, 'info')
+    else:
+        info_dir = info_dir or join(prefix, 'info')
 
     if not run_script(prefix, dist, 'post-link'):
         sys.exit("Error: post-link failed for: %s" % dist)
@@ -376,6 +527,37 @@ def link(prefix, dist, linktype=LINK_HARD, info_dir=None):
     create_meta(prefix, dist, info_dir, meta)
 
 
+def link_concurrently(prefix, dists, linktype=LINK_HARD):
+    """
+    Link the packages `dists` in a specified prefix.  As the files of
+    different packages are disjoint, the files of all packages are placed
+    concurrently, using up to WORKERS threads.  Afterwards, the post-link
+    scripts are run (and the metadata is created) in the order of `dists`.
+    """
+    from multiprocessing.pool import ThreadPool
+
+    def place(dist):
+        try:
+            # one thread per package already
+            return place_files(prefix, dist, linktype, workers=1), None
+        except (Exception, SystemExit) as e:
+            # SystemExit would otherwise kill the worker thread of the pool
+            return None, e
+
+    pool = ThreadPool(max(1, min(WORKERS, len(dists))))
+    try:
+        results = pool.map(place, dists)
+    finally:
+        pool.close()
+        pool.join()
+    # report the error of the first package, in the order of `dists`
+    for files, e in results:
+        if e is not None:
+            raise e
+    for dist, (files, e) in zip(dists, results):
+        finish_link(prefix, dist, files, linktype)
+
+
 def duplicates_to_remove(linked_dists, keep_dists):
     """
     Returns the (sorted) list of distributions to be removed, such that
@@ -456,7 +638,7 @@ def link_dist(dist, linktype=None):
     link(prefix, dist, linktype)
 
 
-def link_idists():
+def link_idists(concurrent=False):
     linktype = determine_link_type_capability()
     for env_name in sorted(C_ENVS):
         dists = C_ENVS[env_name]
@@ -467,7 +649,11 @@ def link_idists():
         prefix = prefix_env(env_name)
         for dist in dists:
             assert dist in IDISTS
-            link_dist(dist, linktype)
+        if concurrent:
+            link_concurrently(prefix, dists, linktype)
+        else:
+            for dist in dists:
+                link(prefix, dist, linktype)
 
         for dist in duplicates_to_remove(linked(prefix), dists):
             meta_path = join(prefix, 'conda-meta', dist + '.json')
@@ -520,7 +706,7 @@ def multi_post_extract():
 
 
 def main():
-    global SKIP_SCRIPTS, ROOT_PREFIX, PKGS_DIR
+    global SKIP_SCRIPTS, ROOT_PREFIX, PKGS_DIR, WORKERS
 
     p = OptionParser(description="conda post extract tool used by installers")
 
@@ -541,6 +727,19 @@ def main():
                  default=None,
                  help="link dist")
 
+    p.add_option('--concurrent-link',
+                 action="store_true",
+                 help="place the files of all packages concurrently, "
+                      "and run the post-link scripts afterwards")
+
+    p.add_option('--workers',
+                 action="store",
+                 type="int",
+                 default=WORKERS,
+                 help="number of threads used to update the prefix in "
+                      "files (defaults to %default)",
+                 metavar='N')
+
     p.add_option('--root-prefix',
                  action="store",
                  default=abspath(join(__file__, '..', '..')),
@@ -555,6 +754,7 @@ def main():
     opts, args = p.parse_args()
     ROOT_PREFIX = opts.root_prefix.replace('//', '/')
     PKGS_DIR = join(ROOT_PREFIX, 'pkgs')
+    WORKERS = max(1, opts.workers)
 
     if args:
         p.error('no arguments expected')
@@ -582,7 +782,7 @@ def main():
         return
 
     if IDISTS:
-        link_idists()
+        link_idists(opts.concurrent_link)
     else:
         post_extract()
 
@@ -59,7 +59,9 @@ def get_output_filename(info):
 
 def main_build(dir_path, output_dir='.', platform=cc_platform,
                verbose=True, cache_dir=DEFAULT_CACHE_DIR,
-               dry_run=False, conda_exe="conda.exe"):
+               dry_run=False, conda_exe="conda.exe", fetch_workers=None,
+               extract_workers=None, verify_cache=False, no_solve_cache=False,
+               repodata_max_age=0, offline_repodata=False):
     print('platform: %s' % platform)
     if not os.path.isfile(conda_exe):
         sys.exit("Error: Conda executable '%s' does not exist!" % conda_exe)
@@ -75,6 +77,14 @@ def main_build(dir_path, output_dir='.', platform=cc_platform,
     info['_platform'] = platform
     info['_download_dir'] = join(cache_dir, platform)
     info['_conda_exe'] = abspath(conda_exe)
+    info['_verify_cache'] = verify_cache
+    info['_no_solve_cache'] = no_solve_cache
+    info['_repodata_max_age'] = repodata_max_age
+    info['_offline_repodata'] = offline_repodata
+    if fetch_workers is not None:
+        info['fetch_workers'] = fetch_workers
+    if extract_workers is not None:
+        info['extract_workers'] = extract_workers
     set_installer_type(info)
 
     if info['installer_type'] == 'sh':
@@ -196,6 +206,44 @@ def main():
                  action="store",
                  metavar="CONDA_EXE")
 
+    p.add_argument('--fetch-workers',
+                 help="number of conda packages downloaded concurrently, "
+                      "overrides 'fetch_workers' in construct.yaml",
+                 action="store",
+                 type=int,
+                 metavar="N")
+
+    p.add_argument('--extract-workers',
+                 help="number of conda packages extracted concurrently, "
+                      "overrides 'extract_workers' in construct.yaml",
+                 action="store",
+                 type=int,
+                 metavar="N")
+
+    p.add_argument('--verify-cache',
+                 help="re-compute the checksums of all cached conda packages, "
+                      "instead of trusting the digest index of the cache",
+                 action="store_true")
+
+    p.add_argument('--no-solve-cache',
+                 help="always run the solver, instead of re-using the result of "
+                      "an identical earlier solve from the cache directory",
+                 action="store_true")
+
+    p.add_argument('--repodata-max-age',
+                 help="number of seconds during which the cached repodata of the "
+                      "channels is used as is, afterwards it is only downloaded "
+                      "again when it changed (default: %(default)s)",
+                 action="store",
+                 type=int,
+                 default=0,
+                 metavar="SECONDS")
+
+    p.add_argument('--offline-repodata',
+                 help="always use the cached repodata of the channels for the "
+                      "index cache of the installer, without any request",
+                 action="store_true")
+
     p.add_argument('dir_path',
                    help="directory containing construct.yaml",
                    action="store",
@@ -241,7 +289,13 @@ def main():
     out_dir = normalize_path(args.output_dir)
     main_build(dir_path, output_dir=out_dir, platform=args.platform,
                verbose=args.verbose, cache_dir=args.cache_dir,
-               dry_run=args.dry_run, conda_exe=args.conda_exe)
+               dry_run=args.dry_run, conda_exe=args.conda_exe,
+               fetch_workers=args.fetch_workers,
+               extract_workers=args.extract_workers,
+               verify_cache=args.verify_cache,
+               no_solve_cache=args.no_solve_cache,
+               repodata_max_age=args.repodata_max_age,
+               offline_repodata=args.offline_repodata)
 
 
 if __name__ == '__main__':
@@ -208,7 +208,7 @@ def create(info, verbose=False):
     fresh_dir(PACKAGE_ROOT)
     pkgs_dir = join(prefix, 'pkgs')
     os.makedirs(pkgs_dir)
-    preconda.write_files(info, pkgs_dir)
+    preconda.write_files(info, pkgs_dir, verbose)
 
     # TODO: Refactor code such that the argument to preconda.write_files is
     # /path/to/base/env, so that such workarounds are not required.
@@ -4,18 +4,22 @@
 # constructor is distributed under the terms of the BSD 3-clause license.
 # Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import os
-from os.path import isdir, join, split as path_split
+from os.path import getsize, isdir, isfile, join, split as path_split
 import platform
 import sys
 import time
 
+from .cache import REPODATA_CACHE_DIR
+from .fcp import DEFAULT_FETCH_WORKERS
 from .utils import filename_dist, get_final_url
 
 from . import __version__ as CONSTRUCTOR_VERSION
 from .conda_interface import (
-    CONDA_INTERFACE_VERSION, Dist, MatchSpec, default_prefix, PrefixData, write_repodata, get_repodata,
-    all_channel_urls
+    CONDA_INTERFACE_VERSION, NAV_APPS, Dist, MatchSpec, default_prefix, PrefixData, write_repodata,
+    get_repodata, read_repodata, all_channel_urls
 )
 
 try:
@@ -26,7 +30,57 @@ except:
 files = '.constructor-build.info', 'urls', 'urls.txt', 'env.txt'
 
 
-def write_index_cache(info, dst_dir, used_packages):
+def _load_repodata(info, url, used_packages, nav_apps, expected=frozenset()):
+    """
+    Return (repodata, size in bytes) of `url`, where the size is only non-zero
+    when the repodata already loaded by the solver could be reused.  Only the
+    entries of `used_packages` and `nav_apps` are kept.  The solver's repodata
+    is only reused when it has the entries of all filenames in `expected`.
+    """
+    path = info.get('_repodata_paths', {}).get(url)
+    if path and isfile(path):
+        repodata = read_repodata(path, used_packages, nav_apps)
+        if expected <= set(repodata['packages']) | set(repodata['packages.conda']):
+            return repodata, getsize(path)
+    repodata_cache_dir = join(info['_download_dir'], REPODATA_CACHE_DIR)
+    max_age = info.get('_repodata_max_age', 0)
+    offline = info.get('_offline_repodata', False)
+    path = get_repodata(url, repodata_cache_dir, max_age, offline)
+    return read_repodata(path, used_packages, nav_apps), 0
+
+
+def _timed_load_repodata(info, url, used_packages, nav_apps, expected):
+    t0 = time.time()
+    repodata, size = _load_repodata(info, url, used_packages, nav_apps, expected)
+    return repodata, size, time.time() - t0
+
+
+def _report_index_cache(paths):
+    """
+    Print the size of the index cache files `paths`, and the time taken to
+    parse them, both as written and in the other format.
+    """
+    sizes = {True: 0, False: 0}
+    times = {True: 0.0, False: 0.0}
+    for path in paths:
+        with open(path) as fi:
+            repodata = json.load(fi)
+        for minified in True, False:
+            if minified:
+                text = json.dumps(repodata, separators=(',', ':'))
+            else:
+                text = json.dumps(repodata, indent=2)
+            t0 = time.time()
+            json.loads(text)
+            times[minified] += time.time() - t0
+            sizes[minified] += len(text)
+    for minified in True, False:
+        print("index cache, %s: %.1f KiB, parsed in %.3f s" %
+              ('minified' if minified else 'indented', sizes[minified] / 1024.0,
+               times[minified]))
+
+
+def write_index_cache(info, dst_dir, used_packages, verbose=False):
     cache_dir = join(dst_dir, 'cache')
 
     if not isdir(cache_dir):
@@ -38,7 +92,36 @@ def write_index_cache(info, dst_dir, used_packages):
     _urls = all_channel_urls(url.rstrip('/') for url in list(_remaps) +
                              info.get('channels', []) +
                              info.get('conda_default_channels', []))
-    repodatas = {url: get_repodata(url) for url in _urls}
+    # looked up for every entry of every channel
+    used_fns = frozenset(used_packages)
+    nav_apps = frozenset(info.get('navigator_apps', NAV_APPS))
+    # the filenames of the packages taken from each channel subdir
+    expected = defaultdict(set)
+    for url, _ in info['_urls']:
+        subdir_url, fn = url.rsplit('/', 1)
+        expected[subdir_url].add(fn)
+    # created here, not by get_repodata() in each of the threads below
+    repodata_cache_dir = join(info['_download_dir'], REPODATA_CACHE_DIR)
+    if not isdir(repodata_cache_dir):
+        os.makedirs(repodata_cache_dir)
+    t0 = time.time()
+    repodatas = {}
+    reused = []
+    with ThreadPoolExecutor(info.get('fetch_workers', DEFAULT_FETCH_WORKERS)) as executor:
+        results = executor.map(lambda url: _timed_load_repodata(info, url, used_fns, nav_apps,
+                                                                expected.get(url, frozenset())),
+                               _urls)
+        for url, (repodata, size, elapsed) in zip(_urls, results):
+            repodatas[url] = repodata
+            if size:
+                reused.append(size)
+            if verbose:
+                print("  %s: %.2f s%s" % (url, elapsed, ' (solver)' if size else ''))
+    if verbose:
+        print("index cache: reused the solver's repodata of %d of %d channel "
+              "subdirs (%.1f MiB not downloaded), loaded in %.2f s" %
+              (len(reused), len(repodatas), sum(reused) / 2.0 ** 20,
+               time.time() - t0))
 
     for url, _ in info['_urls']:
         src, subdir, fn = url.rsplit('/', 2)
@@ -60,8 +143,12 @@ def write_index_cache(info, dst_dir, used_packages):
         for subdir in _platforms:
             del repodatas['%s/%s' % (src, subdir)]
 
-    for url, repodata in repodatas.items():
-        write_repodata(cache_dir, url, repodata, used_packages)
+    minify = info.get('minify_index_cache', False)
+    state = info.get('index_cache_state', False)
+    paths = [write_repodata(cache_dir, url, repodata, minify, state)
+             for url, repodata in repodatas.items()]
+    if verbose:
+        _report_index_cache(paths)
 
     for cache_file in os.listdir(cache_dir):
         if not cache_file.endswith(".json"):
@@ -91,7 +178,7 @@ def system_info():
     return out
 
 
-def write_files(info, dst_dir):
+def write_files(info, dst_dir, verbose=False):
     with open(join(dst_dir, '.constructor-build.info'), 'w') as fo:
         json.dump(system_info(), fo)
 
@@ -105,7 +192,7 @@ def write_files(info, dst_dir):
         for url, _ in final_urls_md5s:
             fo.write('%s\n' % url)
 
-    write_index_cache(info, dst_dir, info['_dists'])
+    write_index_cache(info, dst_dir, info['_dists'], verbose)
 
     write_conda_meta(info, dst_dir, final_urls_md5s)
 
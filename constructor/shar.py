@@ -6,19 +6,43 @@
 
 from __future__ import absolute_import, division, print_function
 
+import hashlib
+from multiprocessing import cpu_count
 import os
 from os.path import basename, dirname, getsize, isdir, join
 import shutil
+import subprocess
+import sys
 import tarfile
 import tempfile
+import threading
+import time
+
+try:
+    from shutil import which
+except ImportError:  # Python 2
+    from distutils.spawn import find_executable as which
 
 from .construct import ns_platform
 from .preconda import files as preconda_files, write_files as preconda_write_files
-from .utils import add_condarc, filename_dist, fill_template, md5_files, preprocess, \
+from .utils import add_condarc, filename_dist, fill_template, preprocess, \
     read_ascii_only, get_final_channels
 
 THIS_DIR = dirname(__file__)
 
+# compression of the payload tarball, and the default compression level
+PAYLOAD_COMPRESSIONS = {'none': None, 'bz2': 9, 'xz': 6, 'zstd': 3}
+# read/write buffer used when copying payloads
+COPY_BUFFER_SIZE = 262144
+# the payloads of .sh installers are aligned to blocks of this size, such
+# that they can be extracted using dd with large blocks
+BLOCK_SIZE = 16 * 1024
+
+
+def _block_padding(size):
+    """Return the number of bytes needed to pad `size` bytes to a full block."""
+    return -size % BLOCK_SIZE
+
 
 def read_header_template():
     path = join(THIS_DIR, 'header.sh')
@@ -27,7 +51,13 @@ def read_header_template():
         return fi.read()
 
 
-def get_header(conda_exec, tarball, info):
+def get_header(conda_exec, tarball_size, digests, info):
+    """
+    Return the header of the installer, for the payload consisting of
+    `conda_exec` followed by a tarball of `tarball_size` bytes, where
+    `digests` maps 'md5' and 'sha256' to the hex digests of the payload.
+    The length of the header does not depend on the payload.
+    """
     name = info['name']
 
     has_license = bool('license_file' in info)
@@ -38,6 +68,7 @@ def get_header(conda_exec, tarball, info):
     for key in 'pre_install', 'post_install', 'pre_uninstall':
         ppd['has_%s' % key] = bool(key in info)
     ppd['initialize_by_default'] = info.get('initialize_by_default', None)
+    ppd['payload_compression'] = info.get('payload_compression', 'none')
     install_lines = list(add_condarc(info))
     # Needs to happen first -- can be templated
     replace = {
@@ -47,7 +78,8 @@ def get_header(conda_exec, tarball, info):
         'PLAT': info['_platform'],
         'DEFAULT_PREFIX': info.get('default_prefix',
                                    '$HOME/%s' % name.lower()),
-        'MD5': md5_files([conda_exec, tarball]),
+        'MD5': digests['md5'],
+        'SHA256': digests['sha256'],
         'INSTALL_COMMANDS': '\n'.join(install_lines),
         'pycache': '__pycache__',
     }
@@ -64,9 +96,7 @@ def get_header(conda_exec, tarball, info):
     # Make all replacements before this - nothing beyond here is allowed to change the size of the header.
     #    If the header size changes, the offsets for extracting things will be wrong and nothing will work.
 
-    # block size for dd in bytes
-    block_size = 16 * 1024
-    total_size = len(data) + getsize(conda_exec) + getsize(tarball)
+    total_size = len(data) + getsize(conda_exec) + tarball_size
     # NOTE: strings here need to be the same length for sake of replacement length being same
     whitespace = 0
     def replace_and_add_to_whitespace(data, string, value):
@@ -75,38 +105,142 @@ def get_header(conda_exec, tarball, info):
         data = data.replace(string, str(value) + (' ' * whitespace))
         return data
 
-    for thing, string, extra_skip in ((conda_exec, 'CON_EXE', 0), (tarball, 'TARBALL', getsize(conda_exec))):
-        start = len(data) + extra_skip
-        # 3-part dd to handle block size alignment: https://unix.stackexchange.com/a/121798/34459
-        thing_size = getsize(thing)
-        copy1_size = block_size - (start % block_size)
-        # zero padding is to ensure size of header doesn't change depending on
-        #    size of packages included.  The actual space you have is the number
-        #    of characters in the string here - @NON_PAYLOAD_SIZE@ is 18 chars
-        data = replace_and_add_to_whitespace(data, '@%s_OFFSET_BYTES@' % string, str(start))
-        data = replace_and_add_to_whitespace(data, '@%s_SIZE_BYTES@' % string, str(thing_size))
-        data = replace_and_add_to_whitespace(data, '@%s_START_REMAINDER@' % string, str(copy1_size))
-        copy2_start = start + copy1_size
-        copy2_skip = copy2_start // block_size
-        data = replace_and_add_to_whitespace(data, '@%s_BLOCK_OFFSET@' % string, str(copy2_skip))
-        copy2_blocks = (thing_size - copy2_start + start) // block_size
-        data = replace_and_add_to_whitespace(data, '@%s_SIZE_BLOCKS@' % string, str(copy2_blocks))
-        copy3_start= (copy2_skip + copy2_blocks) * block_size
-        data = replace_and_add_to_whitespace(data, '@%s_REMAINDER_OFFSET@' % string, str(copy3_start))
-        copy3_size = thing_size - copy1_size - (copy2_blocks * block_size)
-        data = replace_and_add_to_whitespace(data, '@%s_END_REMAINDER@' % string, str(copy3_size))
-
-    data = replace_and_add_to_whitespace(data, '@BLOCK_SIZE@', str(block_size))
+    # the payloads start at block boundaries, see create()
+    conda_exec_size = getsize(conda_exec)
+    conda_exec_offset = len(data) + _block_padding(len(data))
+    tarball_offset = conda_exec_offset + conda_exec_size + _block_padding(conda_exec_size)
+    # zero padding is to ensure size of header doesn't change depending on
+    #    size of packages included.  The actual space you have is the number
+    #    of characters in the string here - @CON_EXE_SIZE_BYTES@ is 20 chars
+    data = replace_and_add_to_whitespace(data, '@CON_EXE_BLOCK_OFFSET@',
+                                         str(conda_exec_offset // BLOCK_SIZE))
+    data = replace_and_add_to_whitespace(data, '@CON_EXE_SIZE_BLOCKS@',
+                                         str(tarball_offset // BLOCK_SIZE - conda_exec_offset // BLOCK_SIZE))
+    data = replace_and_add_to_whitespace(data, '@CON_EXE_SIZE_BYTES@', str(conda_exec_size))
+    data = replace_and_add_to_whitespace(data, '@TARBALL_BLOCK_OFFSET@',
+                                         str(tarball_offset // BLOCK_SIZE))
+
+    data = replace_and_add_to_whitespace(data, '@BLOCK_SIZE@', str(BLOCK_SIZE))
     # this one is not zero-padded because it is used in a different way, and is compared
     #    with the actual size at install time (which is not zero padded)
     data = data.replace('@TOTAL_SIZE_BYTES@', str(n))
 
     # assert that the total length of the file hasn't changed because of our string replacement
-    assert len(data) + getsize(conda_exec) + getsize(tarball) == total_size, "Mismatch data length.  Before string format: %s; after: %s" % (total_size, len(data) + getsize(conda_exec) + getsize(tarball))
+    assert len(data) + getsize(conda_exec) + tarball_size == total_size, "Mismatch data length.  Before string format: %s; after: %s" % (total_size, len(data) + getsize(conda_exec) + tarball_size)
 
     return data
 
 
+def _compress_command(compression, level, threads):
+    """
+    Return the command line of an external compressor writing the
+    `compression` data of stdin to stdout, preferring multi-threaded tools,
+    or None when none of them is installed.
+    """
+    if compression == 'bz2':
+        candidates = [['lbzip2', '-n', str(threads)], ['pbzip2', '-p%d' % threads],
+                      ['bzip2']]
+    elif compression == 'xz':
+        candidates = [['xz', '-T', str(threads)]]
+    else:
+        candidates = [['zstd', '-T%d' % threads, '-q']]
+    for cmd in candidates:
+        exe = which(cmd[0])
+        if exe:
+            return [exe] + cmd[1:] + ['-%d' % level, '-c']
+    return None
+
+
+class _HashingWriter(object):
+    """
+    Write-only file object passing the data on to `fo`, while computing its
+    md5 and sha256 digests and its size.
+    """
+    def __init__(self, fo):
+        self.fo = fo
+        self.hashers = [('md5', hashlib.md5()), ('sha256', hashlib.sha256())]
+        self.size = 0
+
+    def write(self, data):
+        self.fo.write(data)
+        for _, h in self.hashers:
+            h.update(data)
+        self.size += len(data)
+
+    def digests(self):
+        return dict((name, h.hexdigest()) for name, h in self.hashers)
+
+
+class _Compressor(object):
+    """
+    Write-only file object compressing the data with `compression`, and
+    writing the compressed data to `fo`.  External multi-threaded compressors
+    are used when available, otherwise the compression modules of the
+    standard library.
+    """
+    def __init__(self, fo, compression, level, threads):
+        self.fo = fo
+        self.compression = compression
+        self.proc = self.compressor = None
+        cmd = _compress_command(compression, level, threads)
+        if cmd:
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.reader = threading.Thread(target=self._read_output)
+            self.reader.start()
+        elif compression == 'bz2':
+            import bz2
+            self.compressor = bz2.BZ2Compressor(level)
+        elif compression == 'xz':
+            try:
+                import lzma
+            except ImportError:
+                sys.exit("Error: 'xz' is required for 'payload_compression: xz'")
+            self.compressor = lzma.LZMACompressor(preset=level)
+        else:
+            sys.exit("Error: 'zstd' is required for 'payload_compression: zstd'")
+
+    def _read_output(self):
+        while True:
+            chunk = self.proc.stdout.read(COPY_BUFFER_SIZE)
+            if not chunk:
+                break
+            self.fo.write(chunk)
+
+    def write(self, data):
+        if self.proc:
+            self.proc.stdin.write(data)
+        else:
+            self.fo.write(self.compressor.compress(data))
+
+    def close(self):
+        if self.proc:
+            self.proc.stdin.close()
+            self.reader.join()
+            if self.proc.wait() != 0:
+                sys.exit("Error: compressing the payload with %s failed" % self.compression)
+        else:
+            self.fo.write(self.compressor.flush())
+
+
+def write_payload(fo, members, compression, level, threads):
+    """
+    Write the tarball of `members`, (path, name in the tarball) pairs, to the
+    write-only file object `fo`, compressed with `compression`.  The tarball
+    is streamed, so it is never held in memory or written to a temporary file.
+    """
+    if compression == 'none':
+        payload = fo
+    else:
+        payload = _Compressor(fo, compression, level, threads)
+    # stream mode, the payload is only ever written sequentially
+    t = tarfile.open(mode='w|', fileobj=payload, bufsize=COPY_BUFFER_SIZE)
+    for path, arcname in members:
+        t.add(path, arcname)
+    t.close()
+    if compression != 'none':
+        payload.close()
+
+
 def create(info, verbose=False):
     tmp_dir_base_path = join(dirname(info['_outpath']), "tmp")
     try:
@@ -114,7 +248,7 @@ def create(info, verbose=False):
     except:
         pass
     tmp_dir = tempfile.mkdtemp(dir=tmp_dir_base_path)
-    preconda_write_files(info, tmp_dir)
+    preconda_write_files(info, tmp_dir, verbose)
 
     preconda_tarball = join(tmp_dir, 'preconda.tar.bz2')
     postconda_tarball = join(tmp_dir, 'postconda.tar.bz2')
@@ -145,30 +279,51 @@ def create(info, verbose=False):
     pre_t.close()
     post_t.close()
 
-    tarball = join(tmp_dir, 'tmp.tar')
-    t = tarfile.open(tarball, 'w')
-    t.add(preconda_tarball, basename(preconda_tarball))
-    t.add(postconda_tarball, basename(postconda_tarball))
-    if 'license_file' in info:
-        t.add(info['license_file'], 'LICENSE.txt')
-    for dist in info['_dists']:
-        fn = filename_dist(dist)
-        t.add(join(info['_download_dir'], fn), 'pkgs/' + fn)
-    t.close()
+    compression = info.get('payload_compression', 'none')
+    if compression not in PAYLOAD_COMPRESSIONS:
+        sys.exit("Error: invalid payload_compression '%s', allowed values are: %s" %
+                 (compression, ', '.join(sorted(PAYLOAD_COMPRESSIONS))))
 
     conda_exec = info["_conda_exe"]
-    header = get_header(conda_exec, tarball, info)
     shar_path = info['_outpath']
+    # The size of the header does not depend on the payload, so a placeholder
+    # is written first, followed by the payload, which is streamed into the
+    # installer and hashed on the way.  The header is then written again.
+    # The header and conda.exe are padded to full blocks, and the checksum
+    # covers everything after the header padding.
+    placeholder = get_header(conda_exec, 0, {'md5': '0' * 32, 'sha256': '0' * 64},
+                             info).encode('utf-8')
+    t0 = time.time()
     with open(shar_path, 'wb') as fo:
-        fo.write(header.encode('utf-8'))
-        for payload in [conda_exec, tarball]:
-            with open(payload, 'rb') as fi:
-                while True:
-                    chunk = fi.read(262144)
-                    if not chunk:
-                        break
-                    fo.write(chunk)
-
-    os.unlink(tarball)
+        fo.write(placeholder)
+        fo.write(b'\0' * _block_padding(len(placeholder)))
+        writer = _HashingWriter(fo)
+        with open(conda_exec, 'rb') as fi:
+            shutil.copyfileobj(fi, writer, COPY_BUFFER_SIZE)
+        writer.write(b'\0' * _block_padding(writer.size))
+        conda_exec_blocks_size = writer.size
+
+        members = [(preconda_tarball, basename(preconda_tarball)),
+                   (postconda_tarball, basename(postconda_tarball))]
+        if 'license_file' in info:
+            members.append((info['license_file'], 'LICENSE.txt'))
+        for dist in info['_dists']:
+            fn = filename_dist(dist)
+            members.append((join(info['_download_dir'], fn), 'pkgs/' + fn))
+        level = info.get('payload_compression_level', PAYLOAD_COMPRESSIONS[compression])
+        threads = info.get('payload_compression_threads', cpu_count())
+        write_payload(writer, members, compression, level, threads)
+
+        tarball_size = writer.size - conda_exec_blocks_size
+        header = get_header(conda_exec, tarball_size, writer.digests(),
+                            info).encode('utf-8')
+        assert len(header) == len(placeholder)
+        fo.seek(0)
+        fo.write(header)
+
     os.chmod(shar_path, 0o755)
+    if verbose:
+        print("payload: %s, %.1f MiB written in %.1f s" %
+              (compression, tarball_size / 2.0 ** 20, time.time() - t0))
+        print("installer size: %.1f MiB" % (getsize(shar_path) / 2.0 ** 20))
     shutil.rmtree(tmp_dir)
@@ -10,7 +10,7 @@ import os
 from os.path import dirname
 import sys
 
-from . import test_install, test_utils
+from . import test_cache, test_fcp, test_install, test_preconda, test_utils
 from .. import __file__ as CONSTRUCTOR_LOCATION, __version__ as CONSTRUCTOR_VERSION
 from ..conda_interface import CONDA_INTERFACE_VERSION, conda_interface_type
 
@@ -34,13 +34,18 @@ def main():
         test_write_images()
     else: # Unix
         from .. import shar
+        from . import test_shar
         shar.read_header_template()
+        test_shar.main()
 
     if sys.platform == 'darwin':
         from ..osxpkg import OSX_DIR
         assert len(os.listdir(OSX_DIR)) == 6
 
     test_utils.main()
+    test_cache.main()
+    test_fcp.main()
+    test_preconda.main()
     assert test_install.run().wasSuccessful() == True
 
 
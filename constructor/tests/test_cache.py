@@ -0,0 +1,89 @@
+import json
+import os
+import shutil
+import tempfile
+from os.path import join
+
+from ..cache import (DIGEST_INDEX_FN, DigestIndex, read_manifest,
+                     read_solve_cache, solve_cache_key, write_manifest,
+                     write_solve_cache)
+from ..utils import hash_files
+
+
+def test_digest_index():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = join(tmp_dir, 'a-1.0-0.tar.bz2')
+        with open(path, 'wb') as fo:
+            fo.write(b'some data')
+        digests = hash_files([path])
+
+        index = DigestIndex(tmp_dir)
+        assert index.digests(path) == digests
+        index.save()
+
+        # tamper with the stored digest, which is then trusted as long as
+        # the file itself is unchanged
+        with open(join(tmp_dir, DIGEST_INDEX_FN)) as fi:
+            entries = json.load(fi)
+        entries['a-1.0-0.tar.bz2']['md5'] = 'bogus'
+        with open(join(tmp_dir, DIGEST_INDEX_FN), 'w') as fo:
+            json.dump(entries, fo)
+        assert DigestIndex(tmp_dir).digests(path)['md5'] == 'bogus'
+        assert DigestIndex(tmp_dir, verify=True).digests(path) == digests
+
+        # replacing the file invalidates the entry
+        os.unlink(path)
+        with open(path, 'wb') as fo:
+            fo.write(b'other data')
+        assert DigestIndex(tmp_dir).digests(path) == hash_files([path])
+
+        # digests recorded after a download are trusted, as long as they
+        # include the requested ones
+        index = DigestIndex(tmp_dir)
+        index.add(path, {'md5': 'verified', 'size': 10})
+        assert index.digests(path, ('md5',)) == {'md5': 'verified', 'size': 10}
+        assert index.digests(path) == hash_files([path])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_solve_cache():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        stamps = [('https://repo.io/main/noarch', '"abc"', None)]
+        key = solve_cache_key(['python'], ('main',), stamps)
+        assert key == solve_cache_key(['python'], ['main'], stamps)
+        assert key != solve_cache_key(['python 3.7'], ('main',), stamps)
+        assert key != solve_cache_key(['python'], ('main',),
+                                      [('https://repo.io/main/noarch', '"def"', None)])
+
+        assert read_solve_cache(tmp_dir, key) is None
+        records = [{'name': 'python', 'version': '3.7.4', 'build': '0'}]
+        write_solve_cache(tmp_dir, key, records)
+        assert read_solve_cache(tmp_dir, key) == records
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_manifest():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        os.makedirs(join(tmp_dir, 'info'))
+        assert read_manifest(tmp_dir, 'abc') is None
+        write_manifest(tmp_dir, 'abc', ['bin/a', 'lib/b'], 42)
+        assert read_manifest(tmp_dir, 'abc') == (['bin/a', 'lib/b'], 42)
+        # a package with the same name, but different content
+        assert read_manifest(tmp_dir, 'def') is None
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def main():
+    test_digest_index()
+    test_solve_cache()
+    test_manifest()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+from os.path import isdir, isfile, join
+
+from ..cache import DIGEST_INDEX_FN
+from ..conda_interface import (PackageRecord, conda_replace_context_default,
+                               env_vars)
+from ..fcp import _fetch, _path_collisions
+from ..utils import md5_files
+
+
+def make_package(channel_dir, name, version='1.0', build='0', files=()):
+    """
+    Create a minimal noarch conda package in the local channel `channel_dir`
+    and return the corresponding PackageRecord.
+    """
+    subdir_dir = join(channel_dir, 'noarch')
+    if not isdir(subdir_dir):
+        os.makedirs(subdir_dir)
+    fn = '%s-%s-%s.tar.bz2' % (name, version, build)
+    index = {'name': name, 'version': version, 'build': build,
+             'build_number': 0, 'subdir': 'noarch', 'depends': []}
+    members = {'info/index.json': json.dumps(index).encode('utf-8'),
+               'info/files': '\n'.join(files).encode('utf-8')}
+    for f in files:
+        members[f] = ('%s from %s\n' % (f, name)).encode('utf-8')
+    path = join(subdir_dir, fn)
+    with tarfile.open(path, 'w:bz2') as t:
+        for arcname, data in sorted(members.items()):
+            tarinfo = tarfile.TarInfo(arcname)
+            tarinfo.size = len(data)
+            t.addfile(tarinfo, io.BytesIO(data))
+    channel_url = 'file://' + channel_dir
+    return PackageRecord(name=name, version=version, build=build,
+                         build_number=0, channel=channel_url,
+                         subdir='noarch', fn=fn,
+                         url='%s/noarch/%s' % (channel_url, fn),
+                         md5=md5_files([path]))
+
+
+def test_fetch_local_channel():
+    tmp_dir = tempfile.mkdtemp()
+    channel_dir = join(tmp_dir, 'channel')
+    download_dir = join(tmp_dir, 'pkgs')
+    os.makedirs(download_dir)
+    try:
+        precs = [make_package(channel_dir, 'pkg%02d' % i,
+                              files=['lib/pkg%02d.txt' % i])
+                 for i in range(20)]
+        # solver order is not alphabetical
+        precs.reverse()
+        with env_vars({"CONDA_PKGS_DIRS": download_dir},
+                      conda_replace_context_default):
+            pc_recs = _fetch(download_dir, precs, fetch_workers=8,
+                             extract_workers=2)
+
+        assert [rec.fn for rec in pc_recs] == [prec.fn for prec in precs]
+        for prec in precs:
+            extracted_package_dir = join(download_dir, prec.fn[:-8])
+            assert isfile(join(download_dir, prec.fn))
+            assert isfile(join(extracted_package_dir, 'lib',
+                               '%s.txt' % prec.name))
+            with open(join(extracted_package_dir, 'info',
+                           'repodata_record.json')) as fi:
+                assert json.load(fi)['md5'] == prec.md5
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_fetch_ignores_other_cached_packages():
+    tmp_dir = tempfile.mkdtemp()
+    channel_dir = join(tmp_dir, 'channel')
+    download_dir = join(tmp_dir, 'pkgs')
+    os.makedirs(download_dir)
+    try:
+        precs = [make_package(channel_dir, name) for name in 'abcd']
+        with env_vars({"CONDA_PKGS_DIRS": download_dir},
+                      conda_replace_context_default):
+            _fetch(download_dir, precs)
+            pc_recs = _fetch(download_dir, precs[2:])
+        assert [rec.fn for rec in pc_recs] == [prec.fn for prec in precs[2:]]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_repodata_record_not_rewritten():
+    tmp_dir = tempfile.mkdtemp()
+    channel_dir = join(tmp_dir, 'channel')
+    download_dir = join(tmp_dir, 'pkgs')
+    os.makedirs(download_dir)
+    try:
+        precs = [make_package(channel_dir, 'a')]
+        record_path = join(download_dir, 'a-1.0-0', 'info',
+                           'repodata_record.json')
+        with env_vars({"CONDA_PKGS_DIRS": download_dir},
+                      conda_replace_context_default):
+            _fetch(download_dir, precs)
+            st = os.stat(record_path)
+            _fetch(download_dir, precs)
+        assert os.stat(record_path).st_ino == st.st_ino
+        assert os.stat(record_path).st_mtime == st.st_mtime
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_fetch_errors_in_solver_order():
+    tmp_dir = tempfile.mkdtemp()
+    channel_dir = join(tmp_dir, 'channel')
+    download_dir = join(tmp_dir, 'pkgs')
+    os.makedirs(download_dir)
+    try:
+        precs = [make_package(channel_dir, name) for name in 'zyxwv']
+        # remove some packages from the channel, after the records were made
+        for prec in precs[1::2]:
+            os.unlink(join(channel_dir, 'noarch', prec.fn))
+        with env_vars({"CONDA_PKGS_DIRS": download_dir},
+                      conda_replace_context_default):
+            try:
+                _fetch(download_dir, precs, fetch_workers=5)
+            except SystemExit as e:
+                msg = str(e)
+            else:
+                raise AssertionError("expected _fetch() to fail")
+        for prec in precs[::2]:
+            assert prec.fn not in msg
+        positions = [msg.index(prec.fn) for prec in precs[1::2]]
+        assert positions == sorted(positions)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_fetch_corrupt_download():
+    tmp_dir = tempfile.mkdtemp()
+    channel_dir = join(tmp_dir, 'channel')
+    download_dir = join(tmp_dir, 'pkgs')
+    os.makedirs(download_dir)
+    try:
+        prec = make_package(channel_dir, 'a')
+        # truncate the package in the channel, after the record was made
+        with open(join(channel_dir, 'noarch', prec.fn), 'r+b') as fo:
+            fo.truncate(10)
+        with env_vars({"CONDA_PKGS_DIRS": download_dir},
+                      conda_replace_context_default):
+            try:
+                _fetch(download_dir, [prec])
+            except SystemExit as e:
+                assert 'checksum mismatch' in str(e)
+            else:
+                raise AssertionError("expected _fetch() to fail")
+        assert not isdir(join(download_dir, 'a-1.0-0'))
+        index_path = join(download_dir, DIGEST_INDEX_FN)
+        if isfile(index_path):
+            with open(index_path) as fi:
+                assert prec.fn not in json.load(fi)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_path_collisions():
+    paths = ['bin/a', 'lib/B', 'lib/b', 'lib/c', 'BIN/A', 'bin/a']
+    assert list(_path_collisions(paths)) == [[0, 4, 5], [1, 2]]
+    assert list(_path_collisions(['a', 'b'])) == []
+    assert list(_path_collisions([])) == []
+
+
+def main():
+    test_fetch_local_channel()
+    test_fetch_ignores_other_cached_packages()
+    test_repodata_record_not_rewritten()
+    test_fetch_errors_in_solver_order()
+    test_fetch_corrupt_download()
+    test_path_collisions()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,65 @@
 import unittest
 import os
+import random
+import re
 import shutil
+import stat
 import json
+import tempfile
 
+from .. import install
 from ..install import (
-    PaddingError, binary_replace, name_dist, url_pat,
-    link_idists, duplicates_to_remove, create_meta
+    COPY_CHUNK_SIZE, PaddingError, binary_replace, name_dist, url_pat,
+    link, link_idists, duplicates_to_remove, create_meta, update_prefix,
+    update_prefix_files, prefix_placeholder
 )
 
 
+def make_pkgs_dir(pkgs_dir, n_packages, n_files):
+    """
+    Create `n_packages` extracted packages, each having `n_files` files (one
+    of which contains the prefix placeholder) and a post-link script, in the
+    package cache directory `pkgs_dir`.  Return the dict of the packages, as
+    in IDISTS.
+    """
+    idists = {}
+    for i in range(n_packages):
+        name = 'pkg%03d' % i
+        dist = '%s-1.0-0' % name
+        files = ['lib/%s/module%03d.py' % (name, j) for j in range(n_files)]
+        files.append('bin/.%s-post-link.sh' % name)
+        contents = dict((f, 'x = %r\n' % f) for f in files)
+        contents[files[0]] = 'prefix = %r\n' % prefix_placeholder
+        contents[files[-1]] = 'echo %s >> "$PREFIX/post-link.log"\n' % name
+        contents['info/files'] = '\n'.join(files)
+        contents['info/has_prefix'] = files[0]
+        contents['info/repodata_record.json'] = json.dumps({'name': name})
+        for f, text in contents.items():
+            path = os.path.join(pkgs_dir, dist, f)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as fo:
+                fo.write(text)
+        idists[dist] = {'url': 'https://repo.io/noarch/%s.tar.bz2' % dist,
+                        'md5': '%032x' % i}
+    with open(os.path.join(pkgs_dir, 'urls'), 'w') as fo:
+        fo.write('\n'.join(idists[dist]['url'] for dist in sorted(idists)))
+    return idists
+
+
+def regex_binary_replace(data, a, b):
+    # the regular expression based implementation binary_replace() replaced
+    def replace(match):
+        occurances = match.group().count(a)
+        padding = (len(a) - len(b)) * occurances
+        if padding < 0:
+            raise PaddingError(a, b, padding)
+        return match.group().replace(a, b) + b'\0' * padding
+
+    pat = re.compile(re.escape(a) + b'([^\0]*?)\0')
+    return pat.sub(replace, data)
+
+
 class TestBinaryReplace(unittest.TestCase):
 
     def test_simple(self):
@@ -50,6 +101,228 @@ class TestBinaryReplace(unittest.TestCase):
         self.assertRaises(PaddingError, binary_replace,
                           b'aaaacaaaa\x00', b'aaaa', b'bbbbb')
 
+    def test_random(self):
+        rnd = random.Random(42)
+        for _ in range(2000):
+            a = b''.join(rnd.choice([b'a', b'b']) for _ in range(rnd.randint(1, 4)))
+            b = b''.join(rnd.choice([b'c', b'/']) for _ in range(rnd.randint(0, 5)))
+            data = b''.join(rnd.choice([a, a, b'a', b'b', b'x', b'\x00'])
+                            for _ in range(rnd.randint(0, 40)))
+            try:
+                expected = regex_binary_replace(data, a, b)
+            except PaddingError as e:
+                expected = e.args
+            try:
+                res = binary_replace(data, a, b)
+            except PaddingError as e:
+                res = e.args
+            self.assertEqual(res, expected, (data, a, b))
+
+
+class TestUpdatePrefix(unittest.TestCase):
+
+    placeholder = '/opt/anaconda1anaconda2anaconda3'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'file')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def update(self, data, new_prefix, mode):
+        with open(self.path, 'wb') as fo:
+            fo.write(data)
+        update_prefix(self.path, new_prefix, self.placeholder, mode)
+        with open(self.path, 'rb') as fi:
+            return fi.read()
+
+    def test_text(self):
+        a = self.placeholder.encode('utf-8')
+        # the placeholders are spread over several copy chunks
+        data = (b'#!' + a + b'/bin/python\n' + b'x' * COPY_CHUNK_SIZE +
+                a + a + b'y' * COPY_CHUNK_SIZE + a)
+        self.assertEqual(self.update(data, '/usr/local/miniconda3', 'text'),
+                         data.replace(a, b'/usr/local/miniconda3'))
+
+    def test_binary(self):
+        a = self.placeholder.encode('utf-8')
+        data = (b'\x7fELF' + a + b'/lib\x00' + b'\x01' * COPY_CHUNK_SIZE +
+                a + b':' + a + b'/bin\x00\x00' + a)
+        self.assertEqual(self.update(data, '/opt/conda', 'binary'),
+                         binary_replace(data, a, b'/opt/conda'))
+
+    def test_unchanged(self):
+        data = b'no placeholder here\n'
+        with open(self.path, 'wb') as fo:
+            fo.write(data)
+        st = os.stat(self.path)
+        for mode in 'text', 'binary':
+            update_prefix(self.path, '/opt/conda', self.placeholder, mode)
+            self.assertEqual(os.stat(self.path).st_ino, st.st_ino)
+            self.assertEqual(os.stat(self.path).st_mtime, st.st_mtime)
+        self.assertEqual(self.update(b'', '/opt/conda', 'text'), b'')
+
+    def test_mode_kept(self):
+        a = self.placeholder.encode('utf-8')
+        for mode in 'text', 'binary':
+            with open(self.path, 'wb') as fo:
+                fo.write(a + b'\x00')
+            os.chmod(self.path, 0o555)
+            update_prefix(self.path, '/opt/conda', self.placeholder, mode)
+            self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o555)
+            with open(self.path, 'rb') as fi:
+                self.assertTrue(fi.read().startswith(b'/opt/conda'))
+            os.unlink(self.path)
+
+    def test_too_long(self):
+        data = b'x' + self.placeholder.encode('utf-8') + b'\x00'
+        with open(self.path, 'wb') as fo:
+            fo.write(data)
+        self.assertRaises(PaddingError, update_prefix, self.path,
+                          '/a/much/longer/prefix/than/the/placeholder',
+                          self.placeholder, 'binary')
+        with open(self.path, 'rb') as fi:
+            self.assertEqual(fi.read(), data)
+        # no temporary file is left behind
+        self.assertEqual(os.listdir(self.tmp_dir), ['file'])
+
+    def test_hard_link(self):
+        # the file is replaced, not modified in place, which leaves other
+        # links to it (and mappings of it) alone
+        data = self.placeholder.encode('utf-8') + b'/lib\x00'
+        link_path = os.path.join(self.tmp_dir, 'link')
+        for mode in 'text', 'binary':
+            with open(self.path, 'wb') as fo:
+                fo.write(data)
+            os.link(self.path, link_path)
+            update_prefix(self.path, '/opt/conda', self.placeholder, mode)
+            with open(link_path, 'rb') as fi:
+                self.assertEqual(fi.read(), data)
+            with open(self.path, 'rb') as fi:
+                self.assertTrue(fi.read().startswith(b'/opt/conda/lib'))
+            os.unlink(link_path)
+
+
+class TestUpdatePrefixFiles(unittest.TestCase):
+
+    placeholder = '/opt/anaconda1anaconda2anaconda3'
+
+    def setUp(self):
+        self.prefix = tempfile.mkdtemp()
+        self.workers = install.WORKERS
+        install.WORKERS = 4
+        self.info_dir = os.path.join(self.prefix, 'info')
+        os.makedirs(self.info_dir)
+        self.has_prefix_files = {}
+        for i in range(50):
+            f = 'share/file%02d.txt' % i
+            self.has_prefix_files[f] = (self.placeholder, 'text')
+            self.write(f, 'prefix=%s\n' % self.placeholder)
+        # the prefix is longer than these placeholders
+        for f in 'lib/libz.so', 'lib/liba.so':
+            self.has_prefix_files[f] = ('/opt', 'binary')
+            self.write(f, '/opt/lib\0')
+
+    def tearDown(self):
+        install.WORKERS = self.workers
+        shutil.rmtree(self.prefix)
+
+    def write(self, f, text):
+        path = os.path.join(self.prefix, f)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fo:
+            fo.write(text)
+
+    def test_errors(self):
+        errors = update_prefix_files(self.prefix, self.has_prefix_files)
+        self.assertEqual([f for f, e in errors], ['lib/liba.so', 'lib/libz.so'])
+        for f, e in errors:
+            self.assertTrue(isinstance(e, PaddingError))
+        for f in self.has_prefix_files:
+            if f.endswith('.txt'):
+                with open(os.path.join(self.prefix, f)) as fi:
+                    self.assertEqual(fi.read(), 'prefix=%s\n' % self.prefix)
+
+    def test_link_reports_package(self):
+        lines = ['%s %s %s' % (placeholder, mode, f)
+                 for f, (placeholder, mode) in self.has_prefix_files.items()]
+        self.write('info/has_prefix', '\n'.join(lines))
+        self.write('info/files', '\n'.join(self.has_prefix_files))
+        self.write('info/repodata_record.json', '{}')
+        try:
+            link(self.prefix, 'foo-1.0-0', linktype=None,
+                 info_dir=self.info_dir)
+        except SystemExit as e:
+            msg = str(e)
+        else:
+            raise AssertionError("expected link() to fail")
+        self.assertEqual(msg, "ERROR: placeholder '/opt' too short in: "
+                              "foo-1.0-0\n")
+
+    def test_link_reraises_errors(self):
+        # a file listed in has_prefix, but missing from the package
+        self.write('info/has_prefix',
+                   '%s text share/missing.txt' % self.placeholder)
+        self.write('info/files', 'share/missing.txt')
+        self.write('info/repodata_record.json', '{}')
+        try:
+            link(self.prefix, 'foo-1.0-0', linktype=None,
+                 info_dir=self.info_dir)
+        except EnvironmentError as e:
+            self.assertEqual(e.filename,
+                             os.path.join(self.prefix, 'share', 'missing.txt'))
+        else:
+            raise AssertionError("expected link() to fail")
+
+
+class TestLinkIdists(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pkgs_dir = os.path.join(self.tmp_dir, 'pkgs')
+        self.globals = dict((k, getattr(install, k)) for k in
+                            ('ROOT_PREFIX', 'PKGS_DIR', 'IDISTS', 'WORKERS'))
+        install.PKGS_DIR = self.pkgs_dir
+        install.IDISTS = make_pkgs_dir(self.pkgs_dir, 20, 5)
+        install.WORKERS = 4
+
+    def tearDown(self):
+        for k, v in self.globals.items():
+            setattr(install, k, v)
+        del install.C_ENVS
+        shutil.rmtree(self.tmp_dir)
+
+    def test_concurrent(self):
+        # not sorted by name, like the dependency order of the solver
+        dists = sorted(install.IDISTS, key=lambda dist: dist[::-1])
+        install.C_ENVS = {'root': dists}
+        prefixes = []
+        for concurrent in False, True:
+            install.ROOT_PREFIX = os.path.join(self.tmp_dir, str(concurrent))
+            os.makedirs(install.ROOT_PREFIX)
+            link_idists(concurrent)
+            with open(os.path.join(install.ROOT_PREFIX, 'post-link.log')) as fi:
+                self.assertEqual(fi.read().split(),
+                                 [name_dist(dist) for dist in dists])
+            prefixes.append(install.ROOT_PREFIX)
+
+        contents = []
+        for prefix in prefixes:
+            res = {}
+            for root, dirs, files in os.walk(prefix):
+                for fn in files:
+                    path = os.path.join(root, fn)
+                    with open(path) as fi:
+                        text = fi.read().replace(prefix, '<prefix>')
+                    res[os.path.relpath(path, prefix)] = text
+            contents.append(res)
+        self.assertEqual(len(contents[0]), 20 * 7 + 1)
+        self.assertEqual(contents[0], contents[1])
+        self.assertEqual(contents[1]['lib/pkg000/module000.py'],
+                         "prefix = '<prefix>'\n")
+
 
 class duplicates_to_remove_TestCase(unittest.TestCase):
 
@@ -169,7 +442,9 @@ class Metadata_TestCase(unittest.TestCase):
 
 def run():
     suite = unittest.TestSuite()
-    for cls in (TestBinaryReplace, duplicates_to_remove_TestCase,
+    for cls in (TestBinaryReplace, TestUpdatePrefix, TestUpdatePrefixFiles,
+                TestLinkIdists,
+                duplicates_to_remove_TestCase,
                 URLPatter_TestCase, Misc_TestCase):
         suite.addTest(unittest.makeSuite(cls))
     runner = unittest.TextTestRunner()
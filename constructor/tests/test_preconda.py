@@ -0,0 +1,212 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from os.path import isfile, join
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from ..conda_interface import all_channel_urls
+from ..preconda import write_index_cache
+
+REPODATA = {'info': {}, 'packages': {}, 'packages.conda': {}, 'removed': []}
+ETAG = '"repodata-1"'
+
+
+class ChannelHandler(BaseHTTPRequestHandler):
+    """Serve the same repodata.json for any subdir, honoring If-None-Match."""
+    bodies_sent = 0
+    repodata = REPODATA
+
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = json.dumps(self.repodata).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', ETAG)
+        self.end_headers()
+        self.wfile.write(body)
+        ChannelHandler.bodies_sent += 1
+
+    def log_message(self, *args):
+        pass
+
+
+def write_solver_repodata(tmp_dir, channel, **repodata):
+    """
+    Write the repodata of all subdirs of `channel` into `tmp_dir`, as loaded
+    by the solver, and return the paths in the form of info['_repodata_paths'].
+    """
+    repodata_paths = {}
+    for i, url in enumerate(all_channel_urls([channel])):
+        repodata_paths[url] = join(tmp_dir, '%d.json' % i)
+        with open(repodata_paths[url], 'w') as fo:
+            json.dump(dict(REPODATA, _url=url, **repodata), fo)
+    return repodata_paths
+
+
+def test_index_cache_conditional_requests():
+    tmp_dir = tempfile.mkdtemp()
+    server = HTTPServer(('127.0.0.1', 0), ChannelHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        info = {'_platform': 'linux-64',
+                '_download_dir': join(tmp_dir, 'pkgs'),
+                '_urls': [],
+                'channels': ['http://127.0.0.1:%d/channel' % server.server_port]}
+        dst_dir = join(tmp_dir, 'dst')
+        ChannelHandler.bodies_sent = 0
+        write_index_cache(info, dst_dir, [])
+        n_subdirs = ChannelHandler.bodies_sent
+        assert n_subdirs > 0
+        cache_files = sorted(os.listdir(join(dst_dir, 'cache')))
+
+        # unchanged repodata is not downloaded again
+        shutil.rmtree(dst_dir)
+        write_index_cache(info, dst_dir, [])
+        assert ChannelHandler.bodies_sent == n_subdirs
+        assert sorted(os.listdir(join(dst_dir, 'cache'))) == cache_files
+
+        # no request at all in offline mode, or while the cache is fresh
+        server.shutdown()
+        for key, value in ('_offline_repodata', True), ('_repodata_max_age', 3600):
+            shutil.rmtree(dst_dir)
+            write_index_cache(dict(info, **{key: value}), dst_dir, [])
+            for fn in cache_files:
+                assert isfile(join(dst_dir, 'cache', fn))
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmp_dir)
+
+
+def test_index_cache_reuses_solver_repodata():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # nothing listens on this port, so any download would fail
+        channel = 'http://127.0.0.1:1/channel'
+        repodata_paths = write_solver_repodata(tmp_dir, channel)
+        info = {'_platform': 'linux-64',
+                '_download_dir': join(tmp_dir, 'pkgs'),
+                '_urls': [],
+                '_repodata_paths': repodata_paths,
+                'channels': [channel]}
+        write_index_cache(info, join(tmp_dir, 'dst'), [])
+        assert len(os.listdir(join(tmp_dir, 'dst', 'cache'))) == len(repodata_paths)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_index_cache_incomplete_solver_repodata():
+    tmp_dir = tempfile.mkdtemp()
+    used = {'used-1.0-0.tar.bz2': {'name': 'used', 'version': '1.0'}}
+    ChannelHandler.repodata = dict(REPODATA, packages=used)
+    server = HTTPServer(('127.0.0.1', 0), ChannelHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        channel = 'http://127.0.0.1:%d/channel' % server.server_port
+        # e.g. stale repodata, which lacks the package used by the installer
+        repodata_paths = write_solver_repodata(tmp_dir, channel)
+        info = {'_platform': 'linux-64',
+                '_download_dir': join(tmp_dir, 'pkgs'),
+                '_urls': [('%s/linux-64/used-1.0-0.tar.bz2' % channel, None)],
+                '_repodata_paths': repodata_paths,
+                'channels': [channel]}
+        dst_dir = join(tmp_dir, 'dst')
+        ChannelHandler.bodies_sent = 0
+        write_index_cache(info, dst_dir, ['used-1.0-0.tar.bz2'])
+        # only the repodata of linux-64 was downloaded again
+        assert ChannelHandler.bodies_sent == 1
+        packages = []
+        for fn in os.listdir(join(dst_dir, 'cache')):
+            with open(join(dst_dir, 'cache', fn)) as fi:
+                packages.extend(json.load(fi)['packages'])
+        assert packages == ['used-1.0-0.tar.bz2']
+    finally:
+        ChannelHandler.repodata = REPODATA
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmp_dir)
+
+
+def test_index_cache_entries():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        channel = 'http://127.0.0.1:1/channel'
+        packages = {'%s-1.0-0.tar.bz2' % name: {'name': name, 'version': '1.0'}
+                    for name in ('used', 'spyder', 'myapp', 'other')}
+        repodata_paths = write_solver_repodata(tmp_dir, channel, packages=packages)
+        info = {'_platform': 'linux-64',
+                '_download_dir': join(tmp_dir, 'pkgs'),
+                '_urls': [],
+                '_repodata_paths': repodata_paths,
+                'channels': [channel]}
+        dst_dir = join(tmp_dir, 'dst')
+        for navigator_apps, expected in ((None, ['spyder', 'used']),
+                                         (['myapp'], ['myapp', 'used'])):
+            if navigator_apps is not None:
+                info['navigator_apps'] = navigator_apps
+            write_index_cache(info, dst_dir, ['used-1.0-0.tar.bz2'])
+            for fn in os.listdir(join(dst_dir, 'cache')):
+                with open(join(dst_dir, 'cache', fn)) as fi:
+                    repodata = json.load(fi)
+                assert sorted(v['name'] for v in repodata['packages'].values()) == expected
+                assert repodata['packages.conda'] == {}
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_index_cache_minified():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        channel = 'http://127.0.0.1:1/channel'
+        repodata_paths = write_solver_repodata(tmp_dir, channel)
+        info = {'_platform': 'linux-64',
+                '_download_dir': join(tmp_dir, 'pkgs'),
+                '_urls': [],
+                '_repodata_paths': repodata_paths,
+                'channels': [channel]}
+        contents = {}
+        for minify in False, True:
+            dst_dir = join(tmp_dir, 'dst-%s' % minify)
+            info.update(minify_index_cache=minify, index_cache_state=minify)
+            write_index_cache(info, dst_dir, [], verbose=True)
+            for fn in os.listdir(join(dst_dir, 'cache')):
+                path = join(dst_dir, 'cache', fn)
+                with open(path) as fi:
+                    text = fi.read()
+                if fn.endswith('.state.json'):
+                    repodata_path = path[:-len('.state.json')] + '.json'
+                    assert json.loads(text)['size'] == os.path.getsize(repodata_path)
+                    continue
+                assert ('\n' in text) is not minify
+                contents.setdefault(fn, []).append(json.loads(text))
+        assert contents
+        for indented, minified in contents.values():
+            assert indented == minified
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def main():
+    test_index_cache_conditional_requests()
+    test_index_cache_reuses_solver_repodata()
+    test_index_cache_incomplete_solver_repodata()
+    test_index_cache_entries()
+    test_index_cache_minified()
+
+
+if __name__ == '__main__':
+    main()
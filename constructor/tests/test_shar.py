@@ -0,0 +1,234 @@
+import bz2
+import hashlib
+import io
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+from os.path import isfile, join
+
+from ..conda_interface import conda_replace_context_default, env_vars
+from ..fcp import _fetch
+from ..shar import (BLOCK_SIZE, _HashingWriter, create, get_header, which,
+                    write_payload)
+from .test_fcp import make_package
+
+try:
+    import lzma
+except ImportError:  # Python 2
+    lzma = None
+
+
+# stand-in for the standalone conda.exe, implementing the commands used by
+# the header of .sh installers
+FAKE_CONDA_EXE = """#!/bin/sh
+if [ "$1" != "constructor" ]; then
+    exit 0
+fi
+shift
+while [ $# -gt 0 ]; do
+    case "$1" in
+        --prefix) PREFIX="$2"; shift ;;
+        *) ACTION="$1" ;;
+    esac
+    shift
+done
+case "$ACTION" in
+    --extract-tar) tar -xf - -C "$PREFIX" ;;
+    --extract-tarball) bzip2 -dc | tar -xf - -C "$PREFIX" ;;
+    --extract-conda-pkgs)
+        echo "$PREFIX" >> "${FAKE_CONDA_LOG:-/dev/null}"
+        for pkg in "$PREFIX"/pkgs/*.tar.bz2; do
+            mkdir -p "${pkg%.tar.bz2}"
+            bzip2 -dc "$pkg" | tar -xf - -C "${pkg%.tar.bz2}"
+        done ;;
+esac
+"""
+
+
+def build_installer(tmp_dir, n_packages, **extra_info):
+    """
+    Build a .sh installer of `n_packages` local packages in `tmp_dir`, using
+    FAKE_CONDA_EXE, and return its path.
+    """
+    channel_dir = join(tmp_dir, 'channel')
+    download_dir = join(tmp_dir, 'pkgs')
+    os.makedirs(download_dir)
+    precs = [make_package(channel_dir, 'pkg%03d' % i, files=['lib/pkg%03d.txt' % i])
+             for i in range(n_packages)]
+    with env_vars({"CONDA_PKGS_DIRS": download_dir},
+                  conda_replace_context_default):
+        pc_recs = _fetch(download_dir, precs)
+    conda_exe = join(tmp_dir, 'conda.exe')
+    with open(conda_exe, 'w') as fo:
+        fo.write(FAKE_CONDA_EXE)
+    os.chmod(conda_exe, 0o755)
+    info = {'name': 'Test', 'version': '1.0', '_platform': 'linux-64',
+            '_outpath': join(tmp_dir, 'Test-1.0-Linux-x86_64.sh'),
+            '_conda_exe': conda_exe, '_download_dir': download_dir,
+            '_dists': [rec.fn for rec in pc_recs],
+            '_urls': [(rec.url, rec.md5) for rec in pc_recs],
+            'specs': [], 'keep_pkgs': True}
+    info.update(extra_info)
+    create(info)
+    return info['_outpath']
+
+
+def test_write_payload():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = join(tmp_dir, 'data')
+        data = os.urandom(100000) + b'constructor payload\n' * 100000
+        with open(path, 'wb') as fo:
+            fo.write(data)
+        for compression in 'none', 'bz2', 'xz', 'zstd':
+            if compression == 'zstd' and not which('zstd'):
+                continue
+            if compression == 'xz' and lzma is None and not which('xz'):
+                continue
+            # like create(), which hashes the payload while writing it
+            out = io.BytesIO()
+            writer = _HashingWriter(out)
+            write_payload(writer, [(path, 'pkgs/data')], compression, 1, 2)
+            payload = out.getvalue()
+            assert writer.size == len(payload)
+            assert writer.digests() == {'md5': hashlib.md5(payload).hexdigest(),
+                                        'sha256': hashlib.sha256(payload).hexdigest()}
+            if compression == 'bz2':
+                payload = bz2.decompress(payload)
+            elif compression == 'xz' and lzma is not None:
+                payload = lzma.decompress(payload)
+            elif compression != 'none':
+                cmd = ['xz' if compression == 'xz' else 'zstd', '-dc']
+                proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                payload = proc.communicate(payload)[0]
+            else:
+                assert len(payload) > len(data)
+            with tarfile.open(fileobj=io.BytesIO(payload)) as t:
+                assert t.getnames() == ['pkgs/data']
+                assert t.extractfile('pkgs/data').read() == data
+            if compression != 'none':
+                assert writer.size < len(data)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_header_size():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        conda_exec = join(tmp_dir, 'conda.exe')
+        with open(conda_exec, 'wb') as fo:
+            fo.write(b'\0' * 12345)
+        info = {'name': 'Test', 'version': '1.0', '_platform': 'linux-64'}
+        placeholder = get_header(conda_exec, 0, {'md5': '0' * 32, 'sha256': '0' * 64},
+                                 info)
+        header = get_header(conda_exec, 3 * 2 ** 30, {'md5': 'e' * 32, 'sha256': 'f' * 64},
+                            info)
+        # the header is written before the size of the payload is known
+        assert len(header) == len(placeholder)
+        assert '# MD5:   %s\n' % ('e' * 32) in header
+        assert '# SHA256: %s\n' % ('f' * 64) in header
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_installer_extraction():
+    if not sys.platform.startswith('linux'):
+        return
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        installer = build_installer(tmp_dir, 10)
+        with open(installer, 'rb') as fi:
+            header = fi.read().split(b'@@END_HEADER@@')[0].decode('utf-8')
+        assert 'tail -n' not in header
+        # the payload is only ever read by dd, with full blocks
+        dd_commands = re.findall(r'^.*\bdd .*$', header, re.M)
+        assert len(dd_commands) == 3, dd_commands
+        for command in dd_commands:
+            assert ' bs=%d ' % BLOCK_SIZE in command, command
+
+        prefix = join(tmp_dir, 'prefix')
+        cmd = ['sh', installer, '-b', '-p', prefix]
+        strace = which('strace')
+        if strace and subprocess.call([strace, '-o', os.devnull, 'true']) != 0:
+            strace = None  # e.g. ptrace is not permitted
+        log = join(tmp_dir, 'strace.log')
+        if strace:
+            cmd = [strace, '-f', '-e', 'trace=execve,read', '-o', log] + cmd
+        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        assert b'mismatch' not in output
+        for i in range(10):
+            assert isfile(join(prefix, 'pkgs', 'pkg%03d-1.0-0' % i, 'lib',
+                               'pkg%03d.txt' % i))
+        if strace:
+            # the reads of the dd processes only, identified by their pid
+            dd_reads = {}
+            with open(log) as fi:
+                for line in fi:
+                    pid, call = line.split(None, 1)
+                    if call.startswith('execve(') and '/dd"' in call.split(',')[0]:
+                        dd_reads[pid] = 0
+                    elif call.startswith('read(') and pid in dd_reads:
+                        dd_reads[pid] += 1
+            assert len(dd_reads) == 3, dd_reads
+            # reading with bs=1 takes a read per byte, i.e. thousands of reads
+            max_reads = os.path.getsize(installer) // BLOCK_SIZE + 20
+            for reads in dd_reads.values():
+                assert reads <= max_reads, (dd_reads, max_reads)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_parallel_package_extraction():
+    if not sys.platform.startswith('linux'):
+        return
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        n_packages = 8
+        installer = build_installer(tmp_dir, n_packages)
+        prefix = join(tmp_dir, 'prefix')
+        log = join(tmp_dir, 'extract.log')
+        env = dict(os.environ, FAKE_CONDA_LOG=log)
+        # the last run updates the existing prefix, whose pkgs/ directory
+        # already holds the extracted packages
+        runs = [(['-j', '1'], 1), ([], 1), (['-j', '4'], 4), (['-u', '-j', '4'], 4)]
+        for options, n_extracts in runs:
+            if os.path.exists(log):
+                os.unlink(log)
+            if '-u' in options:
+                # left behind by the earlier installation, and replaced
+                for i in range(n_packages):
+                    with open(join(prefix, 'pkgs', 'pkg%03d-1.0-0' % i, 'stale'), 'w'):
+                        pass
+            else:
+                shutil.rmtree(prefix, ignore_errors=True)
+            subprocess.check_call(['sh', installer, '-b', '-p', prefix] + options, env=env)
+            with open(log) as fi:
+                extract_prefixes = fi.read().split()
+            if n_extracts == 1:
+                assert extract_prefixes == [prefix]
+            else:
+                assert sorted(extract_prefixes) == [
+                    join(prefix, 'install_tmp', 'extract', str(i)) for i in range(n_extracts)]
+            for i in range(n_packages):
+                assert isfile(join(prefix, 'pkgs', 'pkg%03d-1.0-0.tar.bz2' % i))
+                assert isfile(join(prefix, 'pkgs', 'pkg%03d-1.0-0' % i, 'lib',
+                                   'pkg%03d.txt' % i))
+                assert not os.path.exists(join(prefix, 'pkgs', 'pkg%03d-1.0-0' % i, 'stale'))
+            assert not os.path.exists(join(prefix, 'install_tmp'))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def main():
+    test_write_payload()
+    test_header_size()
+    test_installer_extraction()
+    test_parallel_package_extraction()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,14 @@
-from ..utils import make_VIProductVersion, fill_template, preprocess, normalize_path
+from ..utils import (make_VIProductVersion, fill_template, preprocess, normalize_path,
+                     hash_files, md5_files, iter_json_items, write_file_atomic)
 
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
 from os import sep
+from os.path import join
 
 
 def test_make_VIProductVersion():
@@ -74,11 +82,82 @@ def test_normalize_path():
     assert normalize_path(path) == "test/test/test".replace('/', sep)
 
 
+def test_hash_files():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        contents = [b'', b'abc' * 1000000, b'xyz']
+        paths = []
+        for i, data in enumerate(contents):
+            paths.append(join(tmp_dir, str(i)))
+            with open(paths[-1], 'wb') as fo:
+                fo.write(data)
+        data = b''.join(contents)
+        assert hash_files(paths) == {
+            'md5': hashlib.md5(data).hexdigest(),
+            'sha256': hashlib.sha256(data).hexdigest(),
+            'size': len(data),
+        }
+        assert md5_files(paths) == hashlib.md5(data).hexdigest()
+        assert hash_files(paths[:1], ('sha1',)) == {
+            'sha1': hashlib.sha1(b'').hexdigest(), 'size': 0}
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_write_file_atomic():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = join(tmp_dir, 'index.json')
+        write_file_atomic(path, u'{}')
+        # replaces the existing file, also on Windows
+        write_file_atomic(path, b'[]')
+        with open(path, 'rb') as fi:
+            assert fi.read() == b'[]'
+        assert os.listdir(tmp_dir) == ['index.json']
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_iter_json_items():
+    doc = {'info': {'subdir': 'noarch'},
+           'packages': {'a-1.0-0.tar.bz2': {'name': 'a', 'size': 123456789012},
+                        'b-2.0-0.tar.bz2': {'name': u'b\u00e9', 'depends': ['a >=1']}},
+           'packages.conda': {},
+           'removed': [],
+           'repodata_version': 1,
+           'version': 1.25e10}
+    for indent in None, 2:
+        text = json.dumps(doc, indent=indent, sort_keys=True)
+        # small chunks split keys, strings and numbers across reads
+        for chunk_size in 1, 3, 7, 64 * 1024:
+            items = list(iter_json_items(io.StringIO(u'%s' % text),
+                                         ('packages', 'packages.conda'),
+                                         chunk_size))
+            assert items == [
+                (('info',), doc['info']),
+                (('packages', 'a-1.0-0.tar.bz2'), doc['packages']['a-1.0-0.tar.bz2']),
+                (('packages', 'b-2.0-0.tar.bz2'), doc['packages']['b-2.0-0.tar.bz2']),
+                (('removed',), []),
+                (('repodata_version',), 1),
+                (('version',), 1.25e10),
+            ]
+    for text in u'{"a": 1', u'{"a": 1 "b": 2}', u'[]':
+        try:
+            list(iter_json_items(io.StringIO(text), chunk_size=2))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("expected ValueError for %r" % text)
+
+
 def main():
     test_make_VIProductVersion()
     test_fill_template()
     test_preprocess()
     test_normalize_path()
+    test_hash_files()
+    test_write_file_atomic()
+    test_iter_json_items()
 
 
 if __name__ == '__main__':
@@ -4,10 +4,13 @@
 # constructor is distributed under the terms of the BSD 3-clause license.
 # Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
 
+import json
+import os
 import re
 import sys
 import hashlib
-from os.path import normpath
+import tempfile
+from os.path import basename, dirname, isfile, normpath
 from os import sep
 
 
@@ -29,16 +32,158 @@ def fill_template(data, d):
     return pat.sub(replace, data)
 
 
-def md5_files(paths):
-    h = hashlib.new('md5')
+# read buffer used by hash_files()
+HASH_BUFFER_SIZE = 1024 * 1024
+
+
+def hash_files(paths, algorithms=('md5', 'sha256')):
+    """
+    Compute the digests of the concatenated content of `paths` in a single
+    pass over the data.  Returns a dict mapping each algorithm name to its
+    hex digest, and 'size' to the total number of bytes read.
+    """
+    hashers = [(name, hashlib.new(name)) for name in algorithms]
+    buf = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buf)
+    size = 0
     for path in paths:
         with open(path, 'rb') as fi:
             while True:
-                chunk = fi.read(262144)
-                if not chunk:
+                n = fi.readinto(buf)
+                if not n:
                     break
-                h.update(chunk)
-    return h.hexdigest()
+                for _, h in hashers:
+                    h.update(view[:n])
+                size += n
+    res = dict((name, h.hexdigest()) for name, h in hashers)
+    res['size'] = size
+    return res
+
+
+def md5_files(paths):
+    return hash_files(paths, ('md5',))['md5']
+
+
+def write_file_atomic(path, data):
+    """
+    Write `data` (bytes or text) to `path`, via a temporary file which is
+    renamed, such that readers never see a partially written file.
+    """
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    fd, tmp_path = tempfile.mkstemp(dir=dirname(path), prefix='.%s.' % basename(path))
+    replaced = False
+    try:
+        with os.fdopen(fd, 'wb') as fo:
+            fo.write(data)
+        os.chmod(tmp_path, 0o644)
+        if hasattr(os, 'replace'):
+            os.replace(tmp_path, path)
+        else:  # Python 2
+            if sys.platform == 'win32' and isfile(path):
+                # os.rename() does not replace existing files on Windows
+                os.unlink(path)
+            os.rename(tmp_path, path)
+        replaced = True
+    finally:
+        if not replaced:
+            os.unlink(tmp_path)
+
+
+class _JSONReader(object):
+    """
+    Incremental reader of the JSON document in a text file, which only keeps
+    the part of the document currently being parsed in memory.
+    """
+    whitespace = re.compile(r'[ \t\n\r]*')
+    number_chars = re.compile(r'[0-9.eE+-]*')
+
+    def __init__(self, fi, chunk_size):
+        self.fi = fi
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+
+    def _fill(self, size):
+        chunk = self.fi.read(size)
+        if not chunk:
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Skip whitespace and return the next character."""
+        if self.pos < len(self.buf) and self.buf[self.pos] not in ' \t\n\r':
+            return self.buf[self.pos]
+        while True:
+            self.pos = self.whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill(self.chunk_size):
+                raise ValueError("unexpected end of JSON document")
+
+    def expect(self, chars):
+        c = self.peek()
+        if c not in chars:
+            raise ValueError("expected one of %r in JSON document, got %r" % (chars, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Parse and return the next JSON value."""
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                # the value does not fit into the buffer yet
+                if not self._fill(size):
+                    raise
+                size *= 2
+                continue
+            if (isinstance(value, (int, float)) and
+                    self.number_chars.match(self.buf, end).end() == len(self.buf) and
+                    self._fill(size)):
+                # the number might continue in the next chunk
+                continue
+            self.pos = end
+            return value
+
+    def members(self):
+        """
+        Yield the keys of the JSON object at the current position.  The value
+        of each key needs to be consumed before the next key is requested.
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+
+def iter_json_items(fi, nested=(), chunk_size=64 * 1024):
+    """
+    Incrementally parse the JSON object in the text file `fi`, and yield
+    ((key,), value) for its members.  The members of the keys in `nested`,
+    whose values need to be objects as well, are yielded one at a time as
+    ((key, member key), member value) instead, such that large objects are
+    never held in memory as a whole.
+    """
+    reader = _JSONReader(fi, chunk_size)
+    for key in reader.members():
+        if key in nested:
+            for member_key in reader.members():
+                yield (key, member_key), reader.value()
+        else:
+            yield (key,), reader.value()
 
 
 def make_VIProductVersion(version):
@@ -192,7 +192,7 @@ Error: no file %s
 def create(info, verbose=False):
     verify_nsis_install()
     tmp_dir = tempfile.mkdtemp()
-    preconda_write_files(info, tmp_dir)
+    preconda_write_files(info, tmp_dir, verbose)
     shutil.copyfile(info['_conda_exe'], join(tmp_dir, '_conda.exe'))
 
     if 'pre_install' in info:
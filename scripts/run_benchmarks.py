@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Run benchmarks of performance critical parts of constructor."""
+
+# Standard library imports
+from collections import defaultdict
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+REPO_DIR = os.path.dirname(HERE)
+sys.path.insert(0, REPO_DIR)
+
+
+def measure(func, *args):
+    """Return (seconds, peak traced memory in bytes) of calling func(*args)."""
+    tracemalloc.start()
+    t0 = time.time()
+    func(*args)
+    elapsed = time.time() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def report(name, elapsed, peak=None):
+    line = '%-40s %8.2f s' % (name, elapsed)
+    if peak is not None:
+        line += '  %8.1f MiB peak' % (peak / 2.0 ** 20)
+    print(line)
+
+
+def synthetic_paths(n_packages, n_files):
+    """
+    Yield (package fn, list of paths) of `n_packages` packages, having
+    `n_files` files in total, with a few case-insensitive collisions.
+    """
+    per_package = n_files // n_packages
+    for i in range(n_packages):
+        name = 'pkg%04d' % i
+        paths = ['lib/python3.7/site-packages/%s/module_%05d.py' % (name, j)
+                 for j in range(per_package)]
+        if i % 100 == 1:
+            paths.append('share/doc/README.%s' % ('TXT' if i % 200 else 'txt'))
+        yield '%s-1.0-0.tar.bz2' % name, paths
+
+
+class SyntheticRecord(dict):
+    """The attributes of a PackageCacheRecord used by check_duplicates_files()."""
+    def __init__(self, fn, extracted_package_dir):
+        dict.__init__(self, size=1000)
+        self.fn = fn
+        self.md5 = '0' * 32
+        self.extracted_package_dir = extracted_package_dir
+
+
+def bench_duplicate_files(n_packages=500, n_files=2000000):
+    from constructor.cache import write_manifest
+    from constructor.fcp import _scan_package, check_duplicates_files
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        pc_recs = []
+        for fn, paths in synthetic_paths(n_packages, n_files):
+            pc_rec = SyntheticRecord(fn, os.path.join(tmp_dir, fn[:-8]))
+            os.makedirs(os.path.join(pc_rec.extracted_package_dir, 'info'))
+            write_manifest(pc_rec.extracted_package_dir, pc_rec.md5, paths, 0)
+            pc_recs.append(pc_rec)
+
+        def legacy():
+            # the dict of sets approach used before the sort based detection
+            map_members_scase = defaultdict(set)
+            map_members_icase = defaultdict(lambda: {'files': set(), 'fns': set()})
+            for pc_rec in pc_recs:
+                for short_path in _scan_package(pc_rec)[0]:
+                    map_members_scase[short_path].add(pc_rec.fn)
+                    short_path_lower = short_path.lower()
+                    map_members_icase[short_path_lower]['files'].add(short_path)
+                    map_members_icase[short_path_lower]['fns'].add(pc_rec.fn)
+            return [m for m in map_members_icase
+                    if len(map_members_icase[m]['files']) > 1]
+
+        print('duplicate files, %d packages, %d files:' % (n_packages, n_files))
+        report('  dict of sets', *measure(legacy))
+        report('  check_duplicates_files()',
+               *measure(check_duplicates_files, pc_recs, 'linux-64', True))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_fetch_large_cache(n_packages=300, n_cached=10000):
+    from constructor.conda_interface import conda_replace_context_default, env_vars
+    from constructor.fcp import _fetch
+    from constructor.tests.test_fcp import make_package
+
+    tmp_dir = tempfile.mkdtemp()
+    channel_dir = os.path.join(tmp_dir, 'channel')
+    download_dir = os.path.join(tmp_dir, 'pkgs')
+    os.makedirs(download_dir)
+    try:
+        precs = [make_package(channel_dir, 'pkg%04d' % i) for i in range(n_packages)]
+        print('warm fetch of %d packages:' % n_packages)
+        with env_vars({"CONDA_PKGS_DIRS": download_dir},
+                      conda_replace_context_default):
+            _fetch(download_dir, precs)
+            report('  %d packages in cache' % n_packages,
+                   *measure(_fetch, download_dir, precs))
+
+            # packages left behind by builds of other installers
+            for i in range(n_cached):
+                info_dir = os.path.join(download_dir, 'other%05d-1.0-0' % i, 'info')
+                os.makedirs(info_dir)
+                index = {'name': 'other%05d' % i, 'version': '1.0', 'build': '0',
+                         'build_number': 0, 'subdir': 'noarch', 'depends': []}
+                for fn in 'index.json', 'repodata_record.json':
+                    with open(os.path.join(info_dir, fn), 'w') as fo:
+                        json.dump(index, fo)
+            report('  %d packages in cache' % (n_packages + n_cached),
+                   *measure(_fetch, download_dir, precs))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def write_synthetic_repodata(path, n_entries):
+    """Write a repodata.json file with `n_entries` package entries."""
+    with open(path, 'w') as fo:
+        fo.write('{"_url": "https://conda.example.com/channel/linux-64", '
+                 '"info": {"subdir": "linux-64"}, "packages": {')
+        for i in range(n_entries):
+            name = 'pkg%d' % (i // 10)
+            fn = '%s-1.%d-0.tar.bz2' % (name, i % 10)
+            entry = {'name': name, 'version': '1.%d' % (i % 10), 'build': '0',
+                     'build_number': 0, 'depends': ['python >=3.6', 'numpy'],
+                     'md5': '%032x' % i, 'size': 1000 + i, 'subdir': 'linux-64',
+                     'license': 'BSD', 'timestamp': 1500000000000 + i}
+            fo.write('%s%s: %s' % (', ' if i else '', json.dumps(fn), json.dumps(entry)))
+        fo.write('}, "packages.conda": {}, "removed": [], "repodata_version": 1}')
+
+
+def bench_repodata_filter(n_entries=500000):
+    from constructor.conda_interface import NAV_APPS, read_repodata
+
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'repodata.json')
+    try:
+        write_synthetic_repodata(path, n_entries)
+        used_packages = set('pkg%d-1.0-0.tar.bz2' % i for i in range(0, n_entries // 10, 97))
+
+        def legacy():
+            # json.loads() of the whole document, as done before streaming
+            with open(path) as fi:
+                full_repodata = json.loads(fi.read())
+            packages = {k: v for k, v in full_repodata['packages'].items()
+                        if v['name'] in NAV_APPS}
+            for package in used_packages:
+                if package in full_repodata['packages']:
+                    packages[package] = full_repodata['packages'][package]
+            return packages
+
+        print('repodata filter, %d entries (%.0f MiB):' %
+              (n_entries, os.path.getsize(path) / 2.0 ** 20))
+        report('  json.loads', *measure(legacy))
+        report('  streaming', *measure(read_repodata, path, used_packages))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_payload_compression(size=64 * 2 ** 20):
+    from constructor.shar import PAYLOAD_COMPRESSIONS, _HashingWriter, write_payload
+
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'data')
+    out_path = os.path.join(tmp_dir, 'payload')
+    try:
+        # like the packages in a payload: half already compressed, half text
+        with open(path, 'wb') as fo:
+            fo.write(os.urandom(size // 2))
+            fo.write(b'def function(argument):\n    return argument\n' * (size // 88))
+        print('payload compression, %.0f MiB:' % (os.path.getsize(path) / 2.0 ** 20))
+        for compression in sorted(PAYLOAD_COMPRESSIONS):
+            level = PAYLOAD_COMPRESSIONS[compression]
+            t0 = time.time()
+            # the streaming path of shar.create(), hashing while writing
+            with open(out_path, 'wb') as fo:
+                writer = _HashingWriter(fo)
+                write_payload(writer, [(path, 'pkgs/data')], compression, level,
+                              os.cpu_count())
+            report('  %s%s (%.1f MiB)' % (compression, ' -%d' % level if level else '',
+                                          writer.size / 2.0 ** 20),
+                   time.time() - t0)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_update_prefix(size=500 * 2 ** 20):
+    from constructor.install import binary_replace, update_prefix
+
+    placeholder = '/opt/anaconda1anaconda2anaconda3'
+    new_prefix = '/home/user/miniconda3'
+    a = placeholder.encode('utf-8')
+    b = new_prefix.encode('utf-8')
+    chunk = os.urandom(2 ** 20)
+
+    def legacy(path, mode):
+        # read, replace and rewrite the whole file, as done before mmap
+        with open(path, 'rb') as fi:
+            data = fi.read()
+        if mode == 'text':
+            new_data = data.replace(a, b)
+        else:
+            new_data = binary_replace(data, a, b)
+        os.unlink(path)
+        with open(path, 'wb') as fo:
+            fo.write(new_data)
+
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'libsynthetic.so')
+    try:
+        print('update prefix, %.0f MiB file with 2 placeholders:' % (size / 2.0 ** 20))
+        for mode in 'binary', 'text':
+            for name, func in ('read whole file', legacy), ('mmap', update_prefix):
+                with open(path, 'wb') as fo:
+                    fo.write(a + b'/lib\0')
+                    for _ in range(size // len(chunk)):
+                        fo.write(chunk)
+                    fo.write(a + b'/bin\0')
+                args = (path, mode) if func is legacy else (path, new_prefix, placeholder, mode)
+                report('  %s, %s' % (mode, name), *measure(func, *args))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_binary_replace(size=100 * 2 ** 20):
+    import re
+    from constructor.install import PaddingError, binary_replace
+
+    a = b'/opt/anaconda1anaconda2anaconda3'
+    b = b'/home/user/miniconda3'
+
+    def legacy(data, a, b):
+        # the lazy regular expression used before the direct scan
+        def replace(match):
+            occurances = match.group().count(a)
+            padding = (len(a) - len(b)) * occurances
+            if padding < 0:
+                raise PaddingError(a, b, padding)
+            return match.group().replace(a, b) + b'\0' * padding
+
+        pat = re.compile(re.escape(a) + b'([^\0]*?)\0')
+        return pat.sub(replace, data)
+
+    # long runs without null characters, with a placeholder every 64 KiB
+    block = a + b'/lib:' + b'x' * (2 ** 16 - len(a) - 6) + b'\0'
+    data = block * (size // len(block))
+    print('binary replace, %.0f MiB:' % (len(data) / 2.0 ** 20))
+    for name, func in ('regex', legacy), ('scan', binary_replace):
+        t0 = time.time()
+        func(data, a, b)
+        elapsed = time.time() - t0
+        report('  %s (%.0f MB/s)' % (name, len(data) / 1e6 / elapsed), elapsed)
+
+
+def bench_link_idists(n_packages=200, n_files=100, workers=8):
+    from constructor import install
+    from constructor.tests.test_install import make_pkgs_dir
+
+    tmp_dir = tempfile.mkdtemp()
+    install.PKGS_DIR = os.path.join(tmp_dir, 'pkgs')
+    try:
+        install.IDISTS = make_pkgs_dir(install.PKGS_DIR, n_packages, n_files)
+        install.C_ENVS = {'root': sorted(install.IDISTS)}
+        install.WORKERS = workers
+        print('link %d packages, %d files each:' % (n_packages, n_files + 1))
+        for concurrent in False, True:
+            install.ROOT_PREFIX = os.path.join(tmp_dir, 'prefix-%s' % concurrent)
+            os.makedirs(install.ROOT_PREFIX)
+            report('  %s' % ('concurrent, %d threads' % workers if concurrent
+                             else 'sequential'),
+                   *measure(install.link_idists, concurrent))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+BENCHMARKS = {
+    'binary_replace': bench_binary_replace,
+    'duplicate_files': bench_duplicate_files,
+    'fetch_large_cache': bench_fetch_large_cache,
+    'link_idists': bench_link_idists,
+    'payload_compression': bench_payload_compression,
+    'repodata_filter': bench_repodata_filter,
+    'update_prefix': bench_update_prefix,
+}
+
+
+def run_benchmarks(names):
+    """Run the benchmarks bundled with the repository."""
+    for name in names:
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument('names',
+                   nargs='*',
+                   metavar='NAME',
+                   help="benchmarks to run, any of %s (default: all)" %
+                        ', '.join(sorted(BENCHMARKS)))
+    args = p.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            p.error("unknown benchmark: %s" % name)
+    run_benchmarks(args.names or sorted(BENCHMARKS))
@@ -95,6 +95,7 @@ setup(
     },
     install_requires=[
         "conda >=4.6",
+        "futures ; python_version<'3'",
         "ruamel_yaml",
         "pillow >=3.1 ; platform_system=='Windows'",
         # non-python dependency: "nsis >=3.01 ; platform_system=='Windows'",